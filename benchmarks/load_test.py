@@ -0,0 +1,241 @@
+"""Seeds a dataset and measures throughput and tail latency of the main endpoints.
+
+Run from the repository root, for example against a throwaway SQLite file::
+
+    python -m benchmarks.load_test --database-url sqlite:///bench.db --reset --output bench.json
+
+The app is driven in-process through httpx's ASGI transport and/or over HTTP against a uvicorn subprocess, at each
+requested concurrency level. The listings are measured without the response cache unless ``--response-cache``
+names a backend, so a run times the queries rather than cache hits. Results are printed (or written to ``--output``) as JSON; ``--compare`` checks them
+against an earlier run and exits with status 1 when an endpoint's p95 latency regressed beyond ``--threshold``.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+
+PASSWORD = "benchmark"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", "sqlite:///bench.db"))
+    parser.add_argument("--reset", action="store_true", help="drop and recreate all tables before seeding")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--ads", type=int, default=2000)
+    parser.add_argument("--comments-per-ad", type=int, default=20)
+    parser.add_argument("--concurrency", default="1,8,32", help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint and concurrency level")
+    parser.add_argument("--auth-requests", type=int, default=50, help="requests per level for /token and /register")
+    parser.add_argument("--mode", choices=("inprocess", "uvicorn", "both"), default="inprocess")
+    parser.add_argument("--response-cache", choices=("none", "memory", "redis"), default="none",
+                        help="RESPONSE_CACHE_BACKEND for the app under test")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON report to compare p95 latencies against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative p95 regression")
+    args = parser.parse_args(argv)
+    if args.comments_per_ad > args.users:
+        parser.error("--comments-per-ad cannot exceed --users, a user comments at most once per ad")
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+    return args
+
+
+def seed(args):
+    from sqlalchemy import func, insert, select
+
+    import models
+    import schema
+    from database import engine
+    from service.password_hasher import pwd_context
+
+    if args.reset:
+        models.Base.metadata.drop_all(bind=engine)
+    schema.migrate(engine)
+    hashed_password = pwd_context.hash(PASSWORD)
+    run = uuid.uuid4().hex[:8]
+    with engine.begin() as connection:
+        user_ids = connection.execute(insert(models.User).returning(models.User.id), [
+            {"email": f"bench-{run}-{i}@example.com", "hashed_password": hashed_password} for i in range(args.users)
+        ]).scalars().all()
+        ad_ids = connection.execute(insert(models.Ad).returning(models.Ad.id), [
+            {"title": f"Ad {i}", "description": f"Benchmark ad number {i}", "owner_id": user_ids[i % len(user_ids)]}
+            for i in range(args.ads)
+        ]).scalars().all()
+        for ad_offset in range(0, len(ad_ids), 500):
+            connection.execute(insert(models.Comment), [
+                {"text": f"Comment {j} on ad {ad_id}", "ad_id": ad_id, "owner_id": user_ids[j]}
+                for ad_id in ad_ids[ad_offset:ad_offset + 500] for j in range(args.comments_per_ad)
+            ])
+        total_ads = connection.execute(select(func.count()).select_from(models.Ad)).scalar()
+    print(f"seeded {args.users} users, {args.ads} ads and {args.ads * args.comments_per_ad} comments "
+          f"({total_ads} ads in the database)", file=sys.stderr)
+    return {"emails": [f"bench-{run}-{i}@example.com" for i in range(args.users)], "user_ids": user_ids,
+            "ad_ids": ad_ids, "total_ads": total_ads}
+
+
+def endpoints(dataset, rng):
+    ad_ids = dataset["ad_ids"]
+    emails = dataset["emails"]
+    registrations = itertools.count()
+    run = uuid.uuid4().hex[:8]
+
+    def read_ads(client):
+        # Half of the listings are unfiltered, the other half list a random seeded user's ads.
+        params = {"limit": 50}
+        if rng.random() < 0.5:
+            params["owner_id"] = rng.choice(dataset["user_ids"])
+        return client.get("/ads/", params=params)
+
+    def read_comments(client):
+        return client.get(f"/ads/{rng.choice(ad_ids)}/comments/", params={"limit": 50})
+
+    def token(client):
+        return client.post("/token", data={"username": rng.choice(emails), "password": PASSWORD})
+
+    def register(client):
+        email = f"bench-register-{run}-{next(registrations)}@example.com"
+        return client.post("/register", json={"email": email, "password": PASSWORD})
+
+    return {"GET /ads/": (read_ads, False), "GET /ads/{ad_id}/comments/": (read_comments, False),
+            "POST /token": (token, True), "POST /register": (register, True)}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+async def drive(client, request, total, concurrency):
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                response = await request(client)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - start)
+            errors += failed
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": total, "errors": errors, "seconds": round(elapsed, 4), "rps": round(total / elapsed, 2),
+        **{f"p{int(q * 100)}_ms": round(percentile(latencies, q) * 1000, 3) for q in (0.5, 0.95, 0.99)},
+    }
+
+
+async def run_mode(mode, client, dataset, args):
+    rng = random.Random(args.seed)
+    results = []
+    for name, (request, is_auth) in endpoints(dataset, rng).items():
+        for concurrency in args.concurrency:
+            total = args.auth_requests if is_auth else args.requests
+            await drive(client, request, min(total, concurrency * 2), concurrency)
+            stats = await drive(client, request, total, concurrency)
+            results.append({"mode": mode, "response_cache": args.response_cache, "endpoint": name,
+                            "concurrency": concurrency, **stats})
+            print(f"{mode:9} {args.response_cache:6} {name:28} c={concurrency:<4} {stats['rps']:>9} req/s  p95={stats['p95_ms']}ms",
+                  file=sys.stderr)
+    return results
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_uvicorn(dataset, args):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level",
+                               "warning"], env=os.environ.copy())
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60) as client:
+            for _ in range(100):
+                try:
+                    await client.get("/metrics")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            return await run_mode("uvicorn", client, dataset, args)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def run(args):
+    dataset = seed(args)
+    results = []
+    if args.mode in ("inprocess", "both"):
+        from main import app
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=60) as client:
+            results += await run_mode("inprocess", client, dataset, args)
+    if args.mode in ("uvicorn", "both"):
+        results += await run_uvicorn(dataset, args)
+    return results
+
+
+def compare(report, baseline, threshold):
+    def key(result):
+        # Reports written before --response-cache existed ran against the default in-memory cache.
+        return result["mode"], result.get("response_cache", "memory"), result["endpoint"], result["concurrency"]
+
+    previous = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        before = previous.get(key(result))
+        if before and result["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            regressions.append({"mode": result["mode"], "response_cache": result["response_cache"],
+                                "endpoint": result["endpoint"],
+                                "concurrency": result["concurrency"], "baseline_p95_ms": before["p95_ms"],
+                                "p95_ms": result["p95_ms"]})
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["RESPONSE_CACHE_BACKEND"] = args.response_cache
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    results = asyncio.run(run(args))
+    report = {
+        "config": {"database_url": args.database_url, "response_cache": args.response_cache, "users": args.users, "ads": args.ads,
+                   "comments_per_ad": args.comments_per_ad, "concurrency": args.concurrency, "seed": args.seed},
+        "results": results,
+    }
+    if args.compare:
+        with open(args.compare) as baseline:
+            report["regressions"] = compare(report, json.load(baseline), args.threshold)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+    return 1 if report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class CacheBackend:
+    """Storage for cached response bodies plus the never-evicted counters used to invalidate them."""
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl: float):
+        raise NotImplementedError
+
+    def get_counter(self, key: str) -> int:
+        raise NotImplementedError
+
+    def incr(self, key: str) -> int:
+        raise NotImplementedError
+
+    def mark(self, key: str, ttl: float):
+        """Sets a flag that ``is_marked`` reports for the next ``ttl`` seconds."""
+        raise NotImplementedError
+
+    def is_marked(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LocalCounters(CacheBackend):
+    """Counters held by this process."""
+
+    def __init__(self):
+        self._counters = {}
+        self._marks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_counter(self, key: str) -> int:
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def mark(self, key: str, ttl: float):
+        now = time.monotonic()
+        with self._lock:
+            self._marks.pop(key, None)
+            self._marks[key] = now + ttl
+            # Marks are set with the same ttl, so the expired ones are at the front.
+            while next(iter(self._marks.values())) <= now:
+                self._marks.popitem(last=False)
+
+    def is_marked(self, key: str) -> bool:
+        return self._marks.get(key, 0) > time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._marks.clear()
+
+
+class NullCache(CacheBackend):
+    """Stores nothing; every listing is rendered."""
+
+    def get(self, key: str) -> Optional[bytes]:
+        return None
+
+    def set(self, key: str, value: bytes, ttl: float):
+        pass
+
+    def get_counter(self, key: str) -> int:
+        return 0
+
+    def incr(self, key: str) -> int:
+        return 0
+
+    def mark(self, key: str, ttl: float):
+        pass
+
+    def is_marked(self, key: str) -> bool:
+        return False
+
+    def clear(self):
+        pass
+
+
+class InMemoryCache(LocalCounters):
+    """Per-process LRU with a TTL on every entry; only consistent when the app runs a single worker."""
+
+    def __init__(self, max_entries: int):
+        super().__init__()
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: bytes, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        super().clear()
+
+
+class RedisCache(CacheBackend):
+    """Shared backend, so that every worker observes the same invalidations."""
+
+    def __init__(self, url: str, prefix: str = "ad_hub:"):
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._client.get(self._prefix + key)
+
+    def set(self, key: str, value: bytes, ttl: float):
+        self._client.set(self._prefix + key, value, px=int(ttl * 1000))
+
+    def get_counter(self, key: str) -> int:
+        return int(self._client.get(self._prefix + key) or 0)
+
+    def incr(self, key: str) -> int:
+        return self._client.incr(self._prefix + key)
+
+    def mark(self, key: str, ttl: float):
+        self._client.set(self._prefix + key, b"1", px=int(ttl * 1000))
+
+    def is_marked(self, key: str) -> bool:
+        return bool(self._client.exists(self._prefix + key))
+
+    def clear(self):
+        for key in self._client.scan_iter(match=self._prefix + "*"):
+            self._client.delete(key)
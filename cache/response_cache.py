@@ -0,0 +1,110 @@
+import hashlib
+from typing import Callable
+
+from cache.backends import CacheBackend, InMemoryCache, NullCache, RedisCache
+from config import (
+    ASYNC_DATABASE_REPLICA_URLS, DATABASE_REPLICA_URLS, READ_YOUR_WRITES_SECONDS, RESPONSE_CACHE_BACKEND,
+    RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_REDIS_URL, RESPONSE_CACHE_TTL,
+)
+
+ADS_NAMESPACE = "ads"
+# Separate from ADS_NAMESPACE because every new comment reorders it, while the id-ordered listing is unaffected.
+POPULAR_ADS_NAMESPACE = "ads:popular"
+
+
+def comments_namespace(ad_id: int):
+    return f"ad:{ad_id}:comments"
+
+
+def body_etag(body: bytes) -> str:
+    """Validator derived from the response bytes, so every worker tags the same listing alike."""
+    return f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against ``etag``."""
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in (tag.removeprefix("W/") for tag in tags)
+
+
+class ResponseCache:
+    """Read-through cache of serialized responses, grouped into namespaces.
+
+    Every namespace has a generation counter that is part of each entry's key. Writers bump the counter after
+    they commit, which orphans all entries of that namespace at once. Readers capture the generation before
+    they query, so a render that raced with a write is stored under the old generation and never served.
+
+    Read replicas may not have a write yet when its invalidation lands. For ``settle_seconds`` after a namespace is
+    invalidated, renders read through the primary, so a lagging replica is never cached under the new generation.
+    """
+
+    def __init__(self, backend: CacheBackend, ttl: float, settle_seconds: float = 0):
+        self.backend = backend
+        self.ttl = ttl
+        self.settle_seconds = settle_seconds
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, namespace: str) -> int:
+        return self.backend.get_counter(f"generation:{namespace}")
+
+    def get(self, namespace: str, generation: int, key: str):
+        body = self.backend.get(f"{namespace}:{generation}:{key}")
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    def set(self, namespace: str, generation: int, key: str, body: bytes):
+        self.backend.set(f"{namespace}:{generation}:{key}", body, self.ttl)
+
+    def settling(self, namespace: str) -> bool:
+        return self.settle_seconds > 0 and self.backend.is_marked(f"settling:{namespace}")
+
+    def get_or_render(self, namespace: str, key: str, render: Callable[[], bytes], read_db=None) -> bytes:
+        """``read_db`` is the session ``render`` reads through; it is switched to the primary while settling."""
+        generation = self.generation(namespace)
+        body = self.get(namespace, generation, key)
+        if body is None:
+            if read_db is not None and self.settling(namespace):
+                read_db.use_primary()
+            body = render()
+            self.set(namespace, generation, key, body)
+        return body
+
+    async def async_get_or_render(self, namespace: str, key: str, render, read_db=None) -> bytes:
+        generation = self.generation(namespace)
+        body = self.get(namespace, generation, key)
+        if body is None:
+            if read_db is not None and self.settling(namespace):
+                read_db.use_primary()
+            body = await render()
+            self.set(namespace, generation, key, body)
+        return body
+
+    def invalidate(self, *namespaces: str):
+        for namespace in namespaces:
+            if self.settle_seconds > 0:
+                # Set before the generation moves, so no render under the new generation can miss it.
+                self.backend.mark(f"settling:{namespace}", self.settle_seconds)
+            self.backend.incr(f"generation:{namespace}")
+
+    def clear(self):
+        self.backend.clear()
+
+
+def _create_backend() -> CacheBackend:
+    if RESPONSE_CACHE_BACKEND == "redis":
+        return RedisCache(RESPONSE_CACHE_REDIS_URL)
+    if RESPONSE_CACHE_BACKEND == "memory":
+        return InMemoryCache(RESPONSE_CACHE_MAX_ENTRIES)
+    return NullCache()
+
+
+response_cache = ResponseCache(
+    _create_backend(), RESPONSE_CACHE_TTL,
+    settle_seconds=READ_YOUR_WRITES_SECONDS if DATABASE_REPLICA_URLS or ASYNC_DATABASE_REPLICA_URLS else 0,
+)
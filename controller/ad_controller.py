@@ -1,43 +1,209 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import orjson
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 
 import dto
 import models
+from cache.response_cache import (
+    ADS_NAMESPACE, POPULAR_ADS_NAMESPACE, body_etag, comments_namespace, etag_matches, response_cache,
+)
+from config import COMMENT_FEED_HEARTBEAT_SECONDS, COMMENT_WRITE_BATCHING
+from controller.db_routing import get_read_db, get_write_db
 from controller.jwt_token import get_current_user
-from database import get_db
+from database import connection_released, get_db
+from metrics import InstrumentedRoute, serialization_timer
 from service.exception.entity_not_found import EntityNotFound
+from service.exception.invalid_cursor import InvalidCursor
 from service.exception.unauthorized_action import UnauthorizedAction
-from service import ad_service
+from service import ad_service, search_service
+from service.comment_feed import comment_feed
+from service.pagination import DEFAULT_PAGE_SIZE, MAX_BATCH_IDS, MAX_PAGE_SIZE
 
-router = APIRouter()
+router = APIRouter(route_class=InstrumentedRoute)
+# Keeps proxies from buffering or caching an event stream.
+EVENT_STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def render_page(page) -> bytes:
+    """Encodes a page of listing rows directly; the row columns are already in the order of the DTO fields."""
+    with serialization_timer():
+        return orjson.dumps({"items": [row._asdict() for row in page["items"]], "next_cursor": page["next_cursor"]})
+
+
+def conditional_response(body: bytes, if_none_match: Optional[str]) -> Response:
+    """The listing, or 304 Not Modified when the client already holds these exact bytes."""
+    etag = body_etag(body)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+def resume_after(last_event_id: Optional[str], after_id: Optional[int]):
+    """The comment id a stream resumes after: the browser's Last-Event-ID on reconnect, else ``after_id``."""
+    if last_event_id is not None and last_event_id.strip().isdigit():
+        return int(last_event_id)
+    return after_id
+
+
+def validate_bulk_ads(items):
+    """Splits the posted items into the valid ads and the validation errors, both by position."""
+    ads, invalid = {}, {}
+    for index, item in enumerate(items):
+        try:
+            ads[index] = dto.AdCreate(**item)
+        except ValidationError as error:
+            invalid[index] = "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors())
+    return ads, invalid
+
+
+def bulk_create_results(count: int, created: dict, invalid: dict):
+    results = []
+    for index in range(count):
+        if index in created:
+            results.append(dto.BulkCreateItemResult(index=index, status=status.HTTP_201_CREATED,
+                                                    ad=dto.Ad(**created[index]._asdict())))
+        else:
+            results.append(dto.BulkCreateItemResult(index=index, status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                                    detail=invalid[index]))
+    return dto.BulkCreateResult(results=results)
+
+
+def bulk_delete_results(outcomes):
+    results = []
+    for ad_id, error in outcomes:
+        if error is None:
+            results.append(dto.BulkItemResult(id=ad_id, status=status.HTTP_204_NO_CONTENT))
+        elif isinstance(error, UnauthorizedAction):
+            results.append(dto.BulkItemResult(id=ad_id, status=status.HTTP_403_FORBIDDEN,
+                                              detail="You are not the owner of this ad"))
+        else:
+            results.append(dto.BulkItemResult(id=ad_id, status=status.HTTP_404_NOT_FOUND, detail="Ad not found"))
+    return dto.BulkResult(results=results)
 
 
 @router.post("/ads/", response_model=dto.Ad, status_code=status.HTTP_201_CREATED)
-async def create_ad(ad: dto.AdCreate, user_id: int = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_ad(ad: dto.AdCreate, user_id: int = Depends(get_current_user), db: Session = Depends(get_write_db)):
     db_ad = models.Ad(**ad.dict(), owner_id=user_id)
-    return ad_service.create_ad(db_ad, db)
+    with connection_released(db):
+        return ad_service.create_ad(db_ad, db)
+
+
+@router.post("/ads/bulk", response_model=dto.BulkCreateResult)
+async def create_ads(items: dto.AdBulkCreate, user_id: int = Depends(get_current_user),
+                     db: Session = Depends(get_write_db)):
+    ads, invalid = validate_bulk_ads(items)
+    created = []
+    if ads:
+        with connection_released(db):
+            created = ad_service.create_ads([ad.dict() for ad in ads.values()], user_id, db)
+    return bulk_create_results(len(items), dict(zip(ads, created)), invalid)
+
+
+@router.post("/ads/bulk-delete", response_model=dto.BulkResult)
+async def delete_ads(bulk: dto.AdBulkDelete, current_user: int = Depends(get_current_user),
+                     db: Session = Depends(get_write_db)):
+    with connection_released(db):
+        outcomes = ad_service.delete_ads(bulk.ids, current_user, db)
+    return bulk_delete_results(outcomes)
+
+
+@router.get("/ads/", response_model=dto.AdPage)
+async def read_ads(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                   owner_id: Optional[int] = None, if_none_match: Optional[str] = Header(None),
+                   db: Session = Depends(get_read_db)):
+    def render():
+        with connection_released(db):
+            page = ad_service.find_ads_page(limit, cursor, owner_id, db)
+        return render_page(page)
+
+    try:
+        body = response_cache.get_or_render(ADS_NAMESPACE, f"{limit}:{cursor}:{owner_id}", render, read_db=db)
+    except InvalidCursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+    return conditional_response(body, if_none_match)
+
+
+@router.get("/ads/popular", response_model=dto.PopularAdPage)
+async def read_popular_ads(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                           if_none_match: Optional[str] = Header(None), db: Session = Depends(get_read_db)):
+    def render():
+        with connection_released(db):
+            page = ad_service.find_popular_ads_page(limit, cursor, db)
+        return render_page(page)
 
+    try:
+        body = response_cache.get_or_render(POPULAR_ADS_NAMESPACE, f"{limit}:{cursor}", render, read_db=db)
+    except InvalidCursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+    return conditional_response(body, if_none_match)
+
+
+@router.get("/ads/search", response_model=dto.AdPage)
+async def search_ads(q: str = Query(..., min_length=1), limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                     cursor: Optional[str] = None, db: Session = Depends(get_read_db)):
+    try:
+        with connection_released(db):
+            return search_service.search_ads(q, limit, cursor, db)
+    except InvalidCursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+
+
+@router.get("/ads/batch", response_model=dto.AdBatch)
+async def read_ads_by_ids(ids: List[int] = Query(..., min_length=1, max_length=MAX_BATCH_IDS),
+                          db: Session = Depends(get_read_db)):
+    with connection_released(db):
+        return ad_service.find_ads_by_ids(ids, db)
+
+
+@router.get("/comments/batch", response_model=dto.CommentBatch)
+async def read_comments_by_ad_ids(ad_ids: List[int] = Query(..., min_length=1, max_length=MAX_BATCH_IDS),
+                                  per_ad_limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                                  db: Session = Depends(get_read_db)):
+    with connection_released(db):
+        return ad_service.find_comments_by_ad_ids(ad_ids, per_ad_limit, db)
+
+
+@router.get("/users/me/ads", response_model=dto.AdPage)
+async def read_my_ads(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                      current_user: int = Depends(get_current_user), db: Session = Depends(get_read_db)):
+    try:
+        with connection_released(db):
+            page = ad_service.find_ads_page(limit, cursor, current_user, db)
+    except InvalidCursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+    return Response(content=render_page(page), media_type="application/json")
 
-@router.get("/ads/", response_model=List[dto.Ad])
-async def read_ads(db: Session = Depends(get_db)):
-    return ad_service.find_all_ads(db)
+
+@router.get("/users/me/comments", response_model=dto.CommentPage)
+async def read_my_comments(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                           current_user: int = Depends(get_current_user), db: Session = Depends(get_read_db)):
+    try:
+        with connection_released(db):
+            page = ad_service.find_owner_comments_page(current_user, limit, cursor, db)
+    except InvalidCursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+    return Response(content=render_page(page), media_type="application/json")
 
 
 @router.put("/ads/{ad_id}", response_model=dto.Ad)
 async def update_ad(ad_id: int, ad: dto.AdUpdate, current_user: int = Depends(get_current_user),
-                    db: Session = Depends(get_db)):
+                    db: Session = Depends(get_write_db)):
     try:
-        db_ad = ad_service.update_ad(ad_id, ad.title, ad.description, current_user, db)
+        with connection_released(db):
+            db_ad = ad_service.update_ad(ad_id, ad.title, ad.description, current_user, db)
     except UnauthorizedAction:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You are not the owner of this ad")
     return db_ad
 
 
 @router.delete("/ads/{ad_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_ad(ad_id: int, current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+async def delete_ad(ad_id: int, current_user: dict = Depends(get_current_user), db: Session = Depends(get_write_db)):
     try:
-        ad_service.delete_ad(ad_id, current_user, db)
+        with connection_released(db):
+            ad_service.delete_ad(ad_id, current_user, db)
     except UnauthorizedAction:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You are not the owner of this ad")
 
@@ -45,16 +211,50 @@ async def delete_ad(ad_id: int, current_user: dict = Depends(get_current_user),
 @router.post("/ads/{ad_id}/comments/", response_model=dto.Comment, status_code=status.HTTP_201_CREATED)
 async def create_comment(ad_id: int, comment: dto.CommentCreate,
                          user_id: int = Depends(get_current_user),
-                         db: Session = Depends(get_db)):
+                         db: Session = Depends(get_write_db)):
     db_comment = models.Comment(**comment.dict(), ad_id=ad_id, owner_id=user_id)
     try:
-        return ad_service.add_comment(db_comment, db)
+        if COMMENT_WRITE_BATCHING:
+            return await ad_service.add_comment_batched(db_comment, db)
+        with connection_released(db):
+            return ad_service.add_comment(db_comment, db)
     except EntityNotFound:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ad not found")
     except ad_service.UserDuplicateCommentException:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="You have already commented on this ad")
 
 
-@router.get("/ads/{ad_id}/comments/", response_model=List[dto.Comment])
-async def read_comments(ad_id: int, db: Session = Depends(get_db)):
-    return ad_service.find_all_comments_of_ad(ad_id, db)
+@router.get("/ads/{ad_id}/comments/", response_model=dto.CommentPage)
+async def read_comments(ad_id: int, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                        cursor: Optional[str] = None, if_none_match: Optional[str] = Header(None),
+                        db: Session = Depends(get_read_db)):
+    def render():
+        with connection_released(db):
+            page = ad_service.find_comments_page(ad_id, limit, cursor, db)
+        return render_page(page)
+
+    try:
+        body = response_cache.get_or_render(comments_namespace(ad_id), f"{limit}:{cursor}", render, read_db=db)
+    except InvalidCursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+    return conditional_response(body, if_none_match)
+
+
+@router.get("/ads/{ad_id}/comments/stream")
+async def stream_comments(ad_id: int, after_id: Optional[int] = Query(None, ge=0),
+                          last_event_id: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    """New comments of the ad as server-sent events, preceded by those after ``after_id`` or Last-Event-ID."""
+    try:
+        with connection_released(db):
+            ad_service.check_ad_exists(ad_id, db)
+    except EntityNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ad not found")
+
+    async def fetch_after(comment_id):
+        # Reads go to the primary: a lagging replica could hide the comments that are being caught up on.
+        with connection_released(db):
+            return ad_service.find_comments_after(ad_id, comment_id, db)
+
+    events = comment_feed.events(ad_id, resume_after(last_event_id, after_id), fetch_after,
+                                 COMMENT_FEED_HEARTBEAT_SECONDS)
+    return StreamingResponse(events, media_type="text/event-stream", headers=EVENT_STREAM_HEADERS)
@@ -0,0 +1,207 @@
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+
+import dto
+import models
+from cache.response_cache import (
+    ADS_NAMESPACE, POPULAR_ADS_NAMESPACE, comments_namespace, response_cache,
+)
+from config import COMMENT_FEED_HEARTBEAT_SECONDS, COMMENT_WRITE_BATCHING
+from controller.ad_controller import (
+    EVENT_STREAM_HEADERS, bulk_create_results, bulk_delete_results, conditional_response, render_page, resume_after,
+    validate_bulk_ads,
+)
+from controller.db_routing import get_async_read_db, get_async_write_db
+from controller.jwt_token import get_current_user
+from database import async_connection_released, get_async_db
+from metrics import InstrumentedRoute
+from service.exception.entity_not_found import EntityNotFound
+from service.exception.invalid_cursor import InvalidCursor
+from service.exception.unauthorized_action import UnauthorizedAction
+from service import async_ad_service
+from service.ad_service import UserDuplicateCommentException
+from service.comment_feed import comment_feed
+from service.pagination import DEFAULT_PAGE_SIZE, MAX_BATCH_IDS, MAX_PAGE_SIZE
+
+router = APIRouter(route_class=InstrumentedRoute)
+
+
+@router.post("/ads/", response_model=dto.Ad, status_code=status.HTTP_201_CREATED)
+async def create_ad(ad: dto.AdCreate, user_id: int = Depends(get_current_user),
+                    db: AsyncSession = Depends(get_async_write_db)):
+    db_ad = models.Ad(**ad.dict(), owner_id=user_id)
+    async with async_connection_released(db):
+        return await async_ad_service.create_ad(db_ad, db)
+
+
+@router.post("/ads/bulk", response_model=dto.BulkCreateResult)
+async def create_ads(items: dto.AdBulkCreate, user_id: int = Depends(get_current_user),
+                     db: AsyncSession = Depends(get_async_write_db)):
+    ads, invalid = validate_bulk_ads(items)
+    created = []
+    if ads:
+        async with async_connection_released(db):
+            created = await async_ad_service.create_ads([ad.dict() for ad in ads.values()], user_id, db)
+    return bulk_create_results(len(items), dict(zip(ads, created)), invalid)
+
+
+@router.post("/ads/bulk-delete", response_model=dto.BulkResult)
+async def delete_ads(bulk: dto.AdBulkDelete, current_user: int = Depends(get_current_user),
+                     db: AsyncSession = Depends(get_async_write_db)):
+    async with async_connection_released(db):
+        outcomes = await async_ad_service.delete_ads(bulk.ids, current_user, db)
+    return bulk_delete_results(outcomes)
+
+
+@router.get("/ads/", response_model=dto.AdPage)
+async def read_ads(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                   owner_id: Optional[int] = None, if_none_match: Optional[str] = Header(None),
+                   db: AsyncSession = Depends(get_async_read_db)):
+    async def render():
+        async with async_connection_released(db):
+            page = await async_ad_service.find_ads_page(limit, cursor, owner_id, db)
+        return render_page(page)
+
+    try:
+        body = await response_cache.async_get_or_render(ADS_NAMESPACE, f"{limit}:{cursor}:{owner_id}", render,
+                                                        read_db=db)
+    except InvalidCursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+    return conditional_response(body, if_none_match)
+
+
+@router.get("/ads/popular", response_model=dto.PopularAdPage)
+async def read_popular_ads(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                           if_none_match: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_read_db)):
+    async def render():
+        async with async_connection_released(db):
+            page = await async_ad_service.find_popular_ads_page(limit, cursor, db)
+        return render_page(page)
+
+    try:
+        body = await response_cache.async_get_or_render(POPULAR_ADS_NAMESPACE, f"{limit}:{cursor}", render, read_db=db)
+    except InvalidCursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+    return conditional_response(body, if_none_match)
+
+
+@router.get("/ads/search", response_model=dto.AdPage)
+async def search_ads(q: str = Query(..., min_length=1), limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                     cursor: Optional[str] = None, db: AsyncSession = Depends(get_async_read_db)):
+    try:
+        async with async_connection_released(db):
+            return await async_ad_service.search_ads(q, limit, cursor, db)
+    except InvalidCursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+
+
+@router.get("/ads/batch", response_model=dto.AdBatch)
+async def read_ads_by_ids(ids: List[int] = Query(..., min_length=1, max_length=MAX_BATCH_IDS),
+                          db: AsyncSession = Depends(get_async_read_db)):
+    async with async_connection_released(db):
+        return await async_ad_service.find_ads_by_ids(ids, db)
+
+
+@router.get("/comments/batch", response_model=dto.CommentBatch)
+async def read_comments_by_ad_ids(ad_ids: List[int] = Query(..., min_length=1, max_length=MAX_BATCH_IDS),
+                                  per_ad_limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                                  db: AsyncSession = Depends(get_async_read_db)):
+    async with async_connection_released(db):
+        return await async_ad_service.find_comments_by_ad_ids(ad_ids, per_ad_limit, db)
+
+
+@router.get("/users/me/ads", response_model=dto.AdPage)
+async def read_my_ads(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                      current_user: int = Depends(get_current_user), db: AsyncSession = Depends(get_async_read_db)):
+    try:
+        async with async_connection_released(db):
+            page = await async_ad_service.find_ads_page(limit, cursor, current_user, db)
+    except InvalidCursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+    return Response(content=render_page(page), media_type="application/json")
+
+
+@router.get("/users/me/comments", response_model=dto.CommentPage)
+async def read_my_comments(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                           current_user: int = Depends(get_current_user),
+                           db: AsyncSession = Depends(get_async_read_db)):
+    try:
+        async with async_connection_released(db):
+            page = await async_ad_service.find_owner_comments_page(current_user, limit, cursor, db)
+    except InvalidCursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+    return Response(content=render_page(page), media_type="application/json")
+
+
+@router.put("/ads/{ad_id}", response_model=dto.Ad)
+async def update_ad(ad_id: int, ad: dto.AdUpdate, current_user: int = Depends(get_current_user),
+                    db: AsyncSession = Depends(get_async_write_db)):
+    try:
+        async with async_connection_released(db):
+            db_ad = await async_ad_service.update_ad(ad_id, ad.title, ad.description, current_user, db)
+    except UnauthorizedAction:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You are not the owner of this ad")
+    return db_ad
+
+
+@router.delete("/ads/{ad_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_ad(ad_id: int, current_user: int = Depends(get_current_user),
+                    db: AsyncSession = Depends(get_async_write_db)):
+    try:
+        async with async_connection_released(db):
+            await async_ad_service.delete_ad(ad_id, current_user, db)
+    except UnauthorizedAction:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You are not the owner of this ad")
+
+
+@router.post("/ads/{ad_id}/comments/", response_model=dto.Comment, status_code=status.HTTP_201_CREATED)
+async def create_comment(ad_id: int, comment: dto.CommentCreate,
+                         user_id: int = Depends(get_current_user),
+                         db: AsyncSession = Depends(get_async_write_db)):
+    db_comment = models.Comment(**comment.dict(), ad_id=ad_id, owner_id=user_id)
+    try:
+        if COMMENT_WRITE_BATCHING:
+            return await async_ad_service.add_comment_batched(db_comment, db)
+        async with async_connection_released(db):
+            return await async_ad_service.add_comment(db_comment, db)
+    except EntityNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ad not found")
+    except UserDuplicateCommentException:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="You have already commented on this ad")
+
+
+@router.get("/ads/{ad_id}/comments/", response_model=dto.CommentPage)
+async def read_comments(ad_id: int, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                        cursor: Optional[str] = None, if_none_match: Optional[str] = Header(None),
+                        db: AsyncSession = Depends(get_async_read_db)):
+    async def render():
+        async with async_connection_released(db):
+            page = await async_ad_service.find_comments_page(ad_id, limit, cursor, db)
+        return render_page(page)
+
+    try:
+        body = await response_cache.async_get_or_render(comments_namespace(ad_id), f"{limit}:{cursor}", render,
+                                                        read_db=db)
+    except InvalidCursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+    return conditional_response(body, if_none_match)
+
+
+@router.get("/ads/{ad_id}/comments/stream")
+async def stream_comments(ad_id: int, after_id: Optional[int] = Query(None, ge=0),
+                          last_event_id: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    try:
+        async with async_connection_released(db):
+            await async_ad_service.check_ad_exists(ad_id, db)
+    except EntityNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ad not found")
+
+    async def fetch_after(comment_id):
+        async with async_connection_released(db):
+            return await async_ad_service.find_comments_after(ad_id, comment_id, db)
+
+    events = comment_feed.events(ad_id, resume_after(last_event_id, after_id), fetch_after,
+                                 COMMENT_FEED_HEARTBEAT_SECONDS)
+    return StreamingResponse(events, media_type="text/event-stream", headers=EVENT_STREAM_HEADERS)
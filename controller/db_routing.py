@@ -0,0 +1,86 @@
+import hashlib
+import hmac
+import time
+from typing import Optional
+
+from fastapi import Cookie, Depends, Header, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from config import LAST_WRITE_SECRET, READ_YOUR_WRITES_SECONDS
+from database import (
+    LazyAsyncSession, LazySession, async_replica_session, async_replicas, async_session_factory, get_async_db, get_db,
+    replica_session, replicas, session_factory,
+)
+
+# Carries the time of the client's last write, so that any worker can keep its reads on the primary for a while.
+LAST_WRITE_COOKIE = "ad_hub_last_write"
+LAST_WRITE_HEADER = "X-Last-Write"
+
+
+def _signature(stamp: str) -> str:
+    return hmac.new(LAST_WRITE_SECRET.encode(), stamp.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def last_write_value(written_at: float) -> str:
+    """The write time with its signature, so a client cannot pin its reads to the primary."""
+    stamp = f"{written_at:.3f}"
+    return f"{stamp}:{_signature(stamp)}"
+
+
+def wrote_recently(last_write_cookie: Optional[str] = Cookie(None, alias=LAST_WRITE_COOKIE),
+                   last_write_header: Optional[str] = Header(None, alias=LAST_WRITE_HEADER)) -> bool:
+    last_write = last_write_header or last_write_cookie
+    if not last_write:
+        return False
+    stamp, _, signature = last_write.partition(":")
+    if not hmac.compare_digest(signature, _signature(stamp)):
+        return False
+    try:
+        return 0 <= time.time() - float(stamp) < READ_YOUR_WRITES_SECONDS
+    except ValueError:
+        return False
+
+
+def record_write(response: Response):
+    """Hands the client the time of its write; browsers send it back as a cookie, API clients as a header."""
+    if READ_YOUR_WRITES_SECONDS <= 0:
+        return
+    last_write = last_write_value(time.time())
+    response.set_cookie(LAST_WRITE_COOKIE, last_write, max_age=int(READ_YOUR_WRITES_SECONDS) + 1, httponly=True,
+                        samesite="lax")
+    response.headers[LAST_WRITE_HEADER] = last_write
+
+
+def get_read_db(recent: bool = Depends(wrote_recently), db: Session = Depends(get_db)):
+    """Session for read-only handlers: a replica, unless none is configured or the caller has just written."""
+    if not replicas.engines or recent:
+        yield db
+        return
+    replica_db = LazySession(replica_session, primary_factory=session_factory)
+    try:
+        yield replica_db
+    finally:
+        replica_db.close()
+
+
+def get_write_db(response: Response, db: Session = Depends(get_db)):
+    """Primary session for handlers that write; the caller's reads then stay on the primary for a while."""
+    record_write(response)
+    yield db
+
+
+async def get_async_read_db(recent: bool = Depends(wrote_recently), db: AsyncSession = Depends(get_async_db)):
+    if not async_replicas.engines or recent:
+        yield db
+        return
+    replica_db = LazyAsyncSession(async_replica_session, primary_factory=async_session_factory)
+    try:
+        yield replica_db
+    finally:
+        await replica_db.close()
+
+
+async def get_async_write_db(response: Response, db: AsyncSession = Depends(get_async_db)):
+    record_write(response)
+    yield db
@@ -0,0 +1,17 @@
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+
+from controller.db_routing import get_read_db
+from metrics import InstrumentedRoute
+from service import export_service
+
+router = APIRouter(route_class=InstrumentedRoute)
+
+
+@router.get("/export/ads")
+def export_ads(format: str = Query("ndjson", pattern="^(ndjson|csv)$"), db: Session = Depends(get_read_db)):
+    if format == "csv":
+        return StreamingResponse(export_service.export_csv(db), media_type="text/csv",
+                                 headers={"Content-Disposition": 'attachment; filename="ads.csv"'})
+    return StreamingResponse(export_service.export_ndjson(db), media_type="application/x-ndjson")
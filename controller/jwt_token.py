@@ -1,20 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
 from fastapi import Depends
 
+from config import TOKEN_CACHE_SIZE
 from service.user_service import InvalidTokenException
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
+class TokenCache:
+    """Bounded LRU of already verified tokens; an entry is dropped once its token's ``exp`` has passed."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and entry[1] <= time.time():
+                del self._entries[token]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token: str, user_id: int, expires_at: float):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[token] = (user_id, expires_at)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
+
+
 def get_current_user(token: str = Depends(oauth2_scheme)):
+    user_id = token_cache.get(token)
+    if user_id is not None:
+        return user_id
     try:
         payload = jwt.decode(token, "SECRET_KEY", algorithms=["HS256"])
         user_id: str = payload.get("sub")
         if user_id is None:
             raise InvalidTokenException()
-        return int(user_id)
     except JWTError:
         raise InvalidTokenException()
+    if payload.get("exp") is not None:
+        token_cache.put(token, int(user_id), payload["exp"])
+    return int(user_id)
@@ -4,24 +4,39 @@ from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 import dto
 from database import get_db
+from metrics import InstrumentedRoute
 
+from service.exception.service_overloaded import ServiceOverloaded
 from service.user_service import create_user, create_access_token, DuplicatedUserException
 
-router = APIRouter()
+router = APIRouter(route_class=InstrumentedRoute)
+
+
+def _overloaded():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many concurrent authentication requests, try again shortly",
+        headers={"Retry-After": "1"},
+    )
 
 
 @router.post("/register", response_model=dto.User, status_code=status.HTTP_201_CREATED)
-def register_user(user: dto.UserCreate, db: Session = Depends(get_db)):
+async def register_user(user: dto.UserCreate, db: Session = Depends(get_db)):
     try:
-        new_user = create_user(user, db)
+        new_user = await create_user(user, db)
     except DuplicatedUserException:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
+    except ServiceOverloaded:
+        raise _overloaded()
     return new_user
 
 
 @router.post("/token")
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    access_token = create_access_token(form_data.username, form_data.password, db)
+    try:
+        access_token = await create_access_token(form_data.username, form_data.password, db)
+    except ServiceOverloaded:
+        raise _overloaded()
     if not access_token:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1,6 +1,8 @@
 from datetime import datetime
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import Annotated, Any, Dict, List, Optional
+
+from config import BULK_MAX_ITEMS
 
 
 class UserBase(BaseModel):
@@ -35,6 +37,54 @@ class Ad(AdBase):
         from_attributes = True
 
 
+class AdPage(BaseModel):
+    items: List[Ad]
+    next_cursor: Optional[str] = None
+
+
+class AdBatch(BaseModel):
+    items: List[Ad]
+    missing_ids: List[int]
+
+
+class PopularAd(Ad):
+    comment_count: int
+
+
+class PopularAdPage(BaseModel):
+    items: List[PopularAd]
+    next_cursor: Optional[str] = None
+
+
+# Items are validated one by one, so an invalid ad is reported on its own instead of failing the whole request.
+AdBulkCreate = Annotated[List[Dict[str, Any]], Field(min_length=1, max_length=BULK_MAX_ITEMS)]
+
+
+class AdBulkDelete(BaseModel):
+    ids: List[int] = Field(min_length=1, max_length=BULK_MAX_ITEMS)
+
+
+class BulkItemResult(BaseModel):
+    id: int
+    status: int
+    detail: Optional[str] = None
+
+
+class BulkResult(BaseModel):
+    results: List[BulkItemResult]
+
+
+class BulkCreateItemResult(BaseModel):
+    index: int
+    status: int
+    ad: Optional[Ad] = None
+    detail: Optional[str] = None
+
+
+class BulkCreateResult(BaseModel):
+    results: List[BulkCreateItemResult]
+
+
 class AdUpdate(BaseModel):
     title: Optional[str] = None
     description: Optional[str] = None
@@ -57,3 +107,16 @@ class Comment(CommentBase):
     class Config:
         from_attributes = True
 
+
+class CommentPage(BaseModel):
+    items: List[Comment]
+    next_cursor: Optional[str] = None
+
+
+class AdComments(CommentPage):
+    ad_id: int
+
+
+class CommentBatch(BaseModel):
+    ads: List[AdComments]
+    missing_ad_ids: List[int]
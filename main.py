@@ -1,17 +1,68 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
+from starlette.concurrency import run_in_threadpool
+import config
+import database
+import metrics
+from cache.response_cache import response_cache
 from controller.ad_controller import router as ad_router
+from controller.async_ad_controller import router as async_ad_router
+from controller.export_controller import router as export_router
+from controller.jwt_token import token_cache
 from controller.user_controller import router as auth_router
 from fastapi import status, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 import uvicorn
 
+from service.comment_feed import comment_feed
 from service.exception.entity_not_found import EntityNotFound
 from service.user_service import InvalidTokenException
 
-app = FastAPI()
 
-app.include_router(ad_router)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.started_at = time.monotonic()
+    # The schema is managed by manage.py; startup never touches the database unless asked to warm the pools.
+    if config.DB_POOL_WARMUP:
+        if config.USE_ASYNC_DB:
+            await database.async_warm_up(config.DB_POOL_WARMUP)
+        await run_in_threadpool(database.warm_up, config.DB_POOL_WARMUP)
+    listener = None
+    if comment_feed.bridged:
+        listener = asyncio.create_task(comment_feed.listen(database.listen_dsn()))
+    yield
+    if listener is not None:
+        listener.cancel()
+    await database.dispose_engines()
+
+
+app = FastAPI(lifespan=lifespan)
+# Reset by the lifespan hook, which runs in each worker after it is forked.
+app.state.started_at = time.monotonic()
+
+app.include_router(async_ad_router if config.USE_ASYNC_DB else ad_router)
 app.include_router(auth_router)
+app.include_router(export_router)
+
+metrics.register_collector(
+    "ad_hub_token_cache_lookups_total", "Verified token cache lookups, by result.",
+    lambda: [({"result": "hit"}, token_cache.hits), ({"result": "miss"}, token_cache.misses)], "counter",
+)
+metrics.register_collector(
+    "ad_hub_token_cache_size", "Tokens held by the verified token cache.",
+    lambda: [({}, token_cache.stats()["size"])],
+)
+metrics.register_collector(
+    "ad_hub_token_cache_max_size", "Capacity of the verified token cache.", lambda: [({}, token_cache.max_size)],
+)
+metrics.register_collector(
+    "ad_hub_response_cache_lookups_total", "Response cache lookups, by result.",
+    lambda: [({"result": "hit"}, response_cache.hits), ({"result": "miss"}, response_cache.misses)], "counter",
+)
 
 
 @app.middleware("http")
@@ -31,5 +82,35 @@ async def general_exception_middleware(request: Request, call_next):
         )
 
 
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    if request.url.path in ("/metrics", "/health"):
+        return await call_next(request)
+    stats = metrics.start_request()
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.finish_request(request.method, getattr(route, "path", "<unmatched>"), response.status_code,
+                           time.perf_counter() - start, stats)
+    return response
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def read_metrics():
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/health", include_in_schema=False)
+async def health():
+    """Liveness of the worker that handled the request; it does not touch the database."""
+    return {
+        "status": "ok",
+        "pid": os.getpid(),
+        "uptime_seconds": round(time.monotonic() - app.state.started_at, 3),
+        "requests_served": metrics.registry.total_requests(),
+        "event_loop": type(asyncio.get_running_loop()).__module__.split(".")[0],
+    }
+
+
 if __name__ == "__main__":
     uvicorn.run(app)
@@ -0,0 +1,33 @@
+"""Schema management, run once per deploy before starting the server.
+
+    python manage.py migrate   # create missing tables and indexes, upgrade existing ones
+    python manage.py verify    # exit with status 1 if the schema is not up to date
+    python manage.py reconcile-comment-counts  # repair ads.comment_count from the comments table
+"""
+import argparse
+import sys
+
+import schema
+from database import engine
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["migrate", "verify", "reconcile-comment-counts"])
+    args = parser.parse_args(argv)
+    if args.command == "migrate":
+        schema.migrate(engine)
+        print("schema is up to date")
+        return 0
+    if args.command == "reconcile-comment-counts":
+        print(f"fixed the comment count of {schema.reconcile_comment_counts(engine)} ad(s)")
+        return 0
+    problems = schema.verify(engine)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    print("schema is up to date" if not problems else f"{len(problems)} schema problem(s), run: python manage.py migrate")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,284 @@
+import functools
+import inspect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event, exc
+
+from config import SLOW_REQUEST_THRESHOLD_MS
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+slow_request_logger = logging.getLogger("ad_hub.slow_requests")
+
+
+class RequestStats:
+    """Everything measured while serving a single request; shared by the tasks and threads handling it."""
+
+    __slots__ = ("db_statements", "db_time", "serialization_time", "endpoint_done", "statements")
+
+    def __init__(self, capture_statements: bool):
+        self.db_statements = 0
+        self.db_time = 0.0
+        self.serialization_time = 0.0
+        self.endpoint_done = None
+        self.statements = [] if capture_statements else None
+
+
+_current_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.latency = Histogram()
+        self.db_time = Histogram()
+        self.serialization_time = Histogram()
+        self.db_statements = 0
+        self.responses = {}
+
+
+class Registry:
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, method: str, route: str, status_code: int, elapsed: float, stats: RequestStats):
+        with self._lock:
+            metrics = self._routes.get((method, route))
+            if metrics is None:
+                metrics = self._routes[(method, route)] = RouteMetrics()
+            metrics.latency.observe(elapsed)
+            metrics.db_time.observe(stats.db_time)
+            metrics.serialization_time.observe(stats.serialization_time)
+            metrics.db_statements += stats.db_statements
+            metrics.responses[status_code] = metrics.responses.get(status_code, 0) + 1
+
+    def total_requests(self) -> int:
+        with self._lock:
+            return sum(sum(metrics.responses.values()) for metrics in self._routes.values())
+
+    def snapshot(self):
+        with self._lock:
+            return sorted(self._routes.items())
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+
+class PoolStats:
+    def __init__(self):
+        self.wait = Histogram()
+        self.timeouts = 0
+        self.overflow_checkouts = 0
+        self._lock = threading.Lock()
+
+    def record_checkout(self, waited: float, overflow: bool):
+        with self._lock:
+            self.wait.observe(waited)
+            self.overflow_checkouts += overflow
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+
+registry = Registry()
+# Checkout statistics of each connection pool, by engine name.
+pool_stats = {}
+# Extra metrics rendered on /metrics, e.g. cache statistics; each collector returns (labels, value) pairs.
+_collectors = {}
+
+
+def register_collector(name: str, help_text: str, collect, metric_type: str = "gauge"):
+    """``metric_type`` is "gauge" or "counter"; counter names end in ``_total``."""
+    _collectors[name] = (help_text, metric_type, collect)
+
+
+def start_request() -> RequestStats:
+    stats = RequestStats(capture_statements=SLOW_REQUEST_THRESHOLD_MS > 0)
+    _current_stats.set(stats)
+    return stats
+
+
+def finish_request(method: str, route: str, status_code: int, elapsed: float, stats: RequestStats):
+    registry.record(method, route, status_code, elapsed, stats)
+    if 0 < SLOW_REQUEST_THRESHOLD_MS <= elapsed * 1000:
+        slow_request_logger.warning(
+            "Slow request %s %s: %.1fms total, %d statements in %.1fms, %.1fms serializing\n%s",
+            method, route, elapsed * 1000, stats.db_statements, stats.db_time * 1000,
+            stats.serialization_time * 1000, "\n".join(stats.statements),
+        )
+
+
+@contextmanager
+def serialization_timer():
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.serialization_time += time.perf_counter() - start
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.db_statements += 1
+        stats.db_time += elapsed
+        if stats.statements is not None:
+            stats.statements.append(statement)
+
+
+def timed_pool_class(base, name: str):
+    """Subclass of the pool class ``base`` recording, under ``name``, how long each checkout waited for a connection.
+
+    A class attribute rather than per-instance state, so the stats survive ``engine.dispose()`` recreating the pool.
+    """
+    stats = pool_stats.setdefault(name, PoolStats())
+
+    class TimedPool(base):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                connection = super()._do_get()
+            except exc.TimeoutError:
+                stats.record_timeout()
+                raise
+            stats.record_checkout(time.perf_counter() - start, self.checkedout() > self.size())
+            return connection
+
+    TimedPool.__name__ = TimedPool.__qualname__ = f"Timed{base.__name__}"
+    return TimedPool
+
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _mark_endpoint_done(endpoint):
+    def mark():
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.endpoint_done = time.perf_counter()
+
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                mark()
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                mark()
+    return wrapper
+
+
+class InstrumentedRoute(APIRoute):
+    """Attributes the time between the endpoint returning and the response being built to serialization."""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, _mark_endpoint_done(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def instrumented_handler(request):
+            response = await handler(request)
+            stats = _current_stats.get()
+            if stats is not None and stats.endpoint_done is not None:
+                stats.serialization_time += time.perf_counter() - stats.endpoint_done
+            return response
+
+        return instrumented_handler
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _render_histogram(lines, name, help_text, samples):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in samples:
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {count}")
+        lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {histogram.count}")
+        lines.append(f"{name}_sum{_labels(**labels)} {histogram.sum}")
+        lines.append(f"{name}_count{_labels(**labels)} {histogram.count}")
+
+
+def render_prometheus() -> str:
+    routes = registry.snapshot()
+    lines = ["# HELP ad_hub_requests_total Requests served, by route and status code.",
+             "# TYPE ad_hub_requests_total counter"]
+    for (method, route), metrics in routes:
+        for status_code, count in sorted(metrics.responses.items()):
+            lines.append(f"ad_hub_requests_total{_labels(method=method, route=route, status=status_code)} {count}")
+    lines.append("# HELP ad_hub_db_statements_total SQL statements executed, by route.")
+    lines.append("# TYPE ad_hub_db_statements_total counter")
+    for (method, route), metrics in routes:
+        lines.append(f"ad_hub_db_statements_total{_labels(method=method, route=route)} {metrics.db_statements}")
+    for name, attribute, help_text in (
+        ("ad_hub_request_duration_seconds", "latency", "Request latency, by route."),
+        ("ad_hub_db_duration_seconds", "db_time", "Time spent executing SQL per request, by route."),
+        ("ad_hub_serialization_duration_seconds", "serialization_time",
+         "Time spent serializing the response per request, by route."),
+    ):
+        samples = [({"method": method, "route": route}, getattr(metrics, attribute))
+                   for (method, route), metrics in routes]
+        _render_histogram(lines, name, help_text, samples)
+    pools = sorted(pool_stats.items())
+    _render_histogram(lines, "ad_hub_db_pool_wait_seconds", "Time spent waiting for a pooled connection, by engine.",
+                      [({"engine": name}, stats.wait) for name, stats in pools])
+    for name, attribute, help_text in (
+        ("ad_hub_db_pool_timeouts_total", "timeouts", "Checkouts that gave up after DB_POOL_TIMEOUT, by engine."),
+        ("ad_hub_db_pool_overflow_checkouts_total", "overflow_checkouts",
+         "Checkouts served by an overflow connection beyond DB_POOL_SIZE, by engine."),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for engine_name, stats in pools:
+            lines.append(f"{name}{_labels(engine=engine_name)} {getattr(stats, attribute)}")
+    for name, (help_text, metric_type, collect) in sorted(_collectors.items()):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in collect():
+            lines.append(f"{name}{_labels(**labels) if labels else ''} {value}")
+    return "\n".join(lines) + "\n"
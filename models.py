@@ -1,11 +1,14 @@
 from datetime import datetime
 
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, UniqueConstraint
+from sqlalchemy import DDL, Column, Integer, String, ForeignKey, DateTime, Index, UniqueConstraint, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
 Base = declarative_base()
 
+# Text search configuration of the Postgres ads.search_vector column and of the queries run against it.
+SEARCH_CONFIG = "english"
+
 
 class User(Base):
     __tablename__ = "users"
@@ -24,9 +27,30 @@ class Ad(Base):
     title = Column(String, nullable=False)
     description = Column(String)
     owner_id = Column(Integer, ForeignKey("users.id"))
+    # Kept in step with the comments table by the ad service; `python manage.py reconcile-comment-counts` repairs it.
+    comment_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     owner = relationship("User", back_populates="ads")
-    comments = relationship("Comment", back_populates="ad", cascade="all, delete")
+    # The database deletes the comments of a deleted ad, so the ORM does not have to load them first.
+    comments = relationship("Comment", back_populates="ad", cascade="all, delete", passive_deletes=True)
+
+
+# Serves the "most discussed" listing, keyset paginated on (comment_count, id).
+Index("ix_ads_comment_count_id", Ad.comment_count.desc(), Ad.id.desc())
+# Serves the listings by owner, keyset paginated on id, and the users foreign key.
+Index("ix_ads_owner_id_id", Ad.owner_id, Ad.id)
+
+
+# Postgres keeps a generated tsvector of the title and description, with a GIN index for ranked full-text search.
+# The column is not mapped: it only exists on Postgres and is never read back into an Ad. The statements are
+# idempotent, so migrations can also run them against tables created before the column existed.
+SEARCH_DDL = (
+    DDL("ALTER TABLE ads ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS "
+        f"(to_tsvector('{SEARCH_CONFIG}', coalesce(title, '') || ' ' || coalesce(description, ''))) STORED"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_ads_search_vector ON ads USING GIN (search_vector)"),
+)
+for statement in SEARCH_DDL:
+    event.listen(Ad.__table__, "after_create", statement.execute_if(dialect="postgresql"))
 
 
 class Comment(Base):
@@ -34,7 +58,7 @@ class Comment(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     text = Column(String, nullable=False)
-    ad_id = Column(Integer, ForeignKey("ads.id"))
+    ad_id = Column(Integer, ForeignKey("ads.id", ondelete="CASCADE"))
     owner_id = Column(Integer, ForeignKey("users.id"))
 
     owner = relationship("User", back_populates="comments")
@@ -42,5 +66,7 @@ class Comment(Base):
 
     __table_args__ = (
         UniqueConstraint('ad_id', 'owner_id', name='unique_ad_owner_comment'),
+        Index('ix_comments_ad_id_id', 'ad_id', 'id'),
+        Index('ix_comments_owner_id_id', 'owner_id', 'id'),
     )
 
@@ -1,19 +1,272 @@
-from sqlalchemy import select, update
-from sqlalchemy.orm import subqueryload
+from sqlalchemy import (
+    Integer, String, and_, column, delete as sql_delete, exists, func, insert, literal, literal_column, select, true,
+    tuple_, union_all, update, values,
+)
+from sqlalchemy.dialects import postgresql, sqlite
 
 import models
 
 
+AD_COLUMNS = (models.Ad.id, models.Ad.title, models.Ad.description, models.Ad.owner_id)
+COMMENT_COLUMNS = (models.Comment.id, models.Comment.text, models.Comment.ad_id, models.Comment.owner_id)
+# Listing columns in the field order of dto.Ad and dto.Comment, so rows can be encoded without a model.
+AD_LISTING_COLUMNS = (models.Ad.title, models.Ad.description, models.Ad.id, models.Ad.owner_id)
+COMMENT_LISTING_COLUMNS = (models.Comment.text, models.Comment.id, models.Comment.owner_id, models.Comment.ad_id)
+POPULAR_AD_LISTING_COLUMNS = (*AD_LISTING_COLUMNS, models.Ad.comment_count)
+# Dialects whose INSERT supports ON CONFLICT ... DO NOTHING.
+UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def ad_by_id_query(ad_id: int):
+    return select(models.Ad).filter(models.Ad.id == ad_id)
+
+
+def ads_page_query(after_id, limit: int, owner_id):
+    query = select(*AD_LISTING_COLUMNS).order_by(models.Ad.id).limit(limit)
+    if after_id is not None:
+        query = query.filter(models.Ad.id > after_id)
+    if owner_id is not None:
+        query = query.filter(models.Ad.owner_id == owner_id)
+    return query
+
+
+def popular_ads_page_query(after, limit: int):
+    """Most commented ads first; ``after`` is the (comment_count, id) of the last ad of the previous page."""
+    query = select(*POPULAR_AD_LISTING_COLUMNS).order_by(
+        models.Ad.comment_count.desc(), models.Ad.id.desc()
+    ).limit(limit)
+    if after is not None:
+        query = query.filter(tuple_(models.Ad.comment_count, models.Ad.id) < tuple_(*after))
+    return query
+
+
+def comments_page_query(ad_id: int, after_id, limit: int):
+    query = select(*COMMENT_LISTING_COLUMNS).filter(models.Comment.ad_id == ad_id).order_by(
+        models.Comment.id
+    ).limit(limit)
+    if after_id is not None:
+        query = query.filter(models.Comment.id > after_id)
+    return query
+
+
+def owner_comments_page_query(owner_id: int, after_id, limit: int):
+    query = select(*COMMENT_LISTING_COLUMNS).filter(models.Comment.owner_id == owner_id).order_by(
+        models.Comment.id
+    ).limit(limit)
+    if after_id is not None:
+        query = query.filter(models.Comment.id > after_id)
+    return query
+
+
+def comments_by_ad_ids_query(ad_ids, per_ad_limit: int, dialect_name: str):
+    """The first ``per_ad_limit`` comments of each requested ad, one row per comment plus one per comment-less ad.
+
+    ``requested_ad_id`` is set on every row of an existing ad, so ads that do not exist are simply absent.
+    """
+    if dialect_name == "postgresql":
+        # A lateral subquery walks ix_comments_ad_id_id and stops after per_ad_limit rows for each ad.
+        comments = select(*COMMENT_LISTING_COLUMNS).where(models.Comment.ad_id == models.Ad.id).order_by(
+            models.Comment.id
+        ).limit(per_ad_limit).lateral()
+        on = true()
+    else:
+        comments = select(
+            *COMMENT_LISTING_COLUMNS,
+            func.row_number().over(partition_by=models.Comment.ad_id, order_by=models.Comment.id).label("position"),
+        ).where(models.Comment.ad_id.in_(ad_ids)).subquery()
+        on = and_(comments.c.ad_id == models.Ad.id, comments.c.position <= per_ad_limit)
+    return select(
+        models.Ad.id.label("requested_ad_id"), comments.c.text, comments.c.id, comments.c.owner_id, comments.c.ad_id
+    ).select_from(models.Ad).outerjoin(comments, on).where(models.Ad.id.in_(ad_ids)).order_by(
+        models.Ad.id, comments.c.id
+    )
+
+
+def search_ads_query(text: str, limit: int, offset: int):
+    """Postgres full-text search over ads.search_vector, best match first."""
+    query = func.websearch_to_tsquery(models.SEARCH_CONFIG, text)
+    search_vector = literal_column("ads.search_vector")
+    rank = func.ts_rank(search_vector, query)
+    return select(*AD_COLUMNS).where(search_vector.op("@@")(query)).order_by(
+        rank.desc(), models.Ad.id
+    ).limit(limit).offset(offset)
+
+
+def ads_by_ids_query(ad_ids):
+    return select(*AD_COLUMNS).filter(models.Ad.id.in_(ad_ids))
+
+
+def ad_exists_query(ad_id: int):
+    return select(exists().where(models.Ad.id == ad_id))
+
+
+def update_owned_ad_query(ad_id: int, owner_id: int, values: dict):
+    if not values:
+        return select(*AD_COLUMNS).filter(models.Ad.id == ad_id, models.Ad.owner_id == owner_id)
+    return update(models.Ad).where(models.Ad.id == ad_id, models.Ad.owner_id == owner_id).values(
+        **values
+    ).returning(*AD_COLUMNS).execution_options(synchronize_session=False)
+
+
+def delete_owned_ad_query(ad_id: int, owner_id: int):
+    # The comments of the ad go with it through the ON DELETE CASCADE of their foreign key.
+    return sql_delete(models.Ad).where(models.Ad.id == ad_id, models.Ad.owner_id == owner_id).returning(
+        models.Ad.id
+    ).execution_options(synchronize_session=False)
+
+
+def insert_comment_query(db_comment: models.Comment, dialect_name: str):
+    """Inserts the comment only if its ad exists; a duplicate or a missing ad both return no row."""
+    source = select(
+        literal(db_comment.text, String), literal(db_comment.ad_id, Integer), literal(db_comment.owner_id, Integer)
+    ).where(exists().where(models.Ad.id == db_comment.ad_id))
+    return UPSERT_INSERTS[dialect_name](models.Comment).from_select(
+        ["text", "ad_id", "owner_id"], source
+    ).on_conflict_do_nothing(index_elements=["ad_id", "owner_id"]).returning(*COMMENT_COLUMNS)
+
+
+def insert_comments_query(db_comments, dialect_name: str):
+    """One INSERT for many comments; those whose ad does not exist or that are duplicates return no row.
+
+    The comments must not repeat an (ad_id, owner_id) pair.
+    """
+    if dialect_name == "postgresql":
+        new_comments = values(
+            column("text", String), column("ad_id", Integer), column("owner_id", Integer), name="new_comments"
+        ).data([(db_comment.text, db_comment.ad_id, db_comment.owner_id) for db_comment in db_comments])
+    else:
+        # SQLite cannot select from a VALUES list with named columns, so the rows are a union of literal selects.
+        new_comments = union_all(*(
+            select(literal(db_comment.text, String).label("text"), literal(db_comment.ad_id, Integer).label("ad_id"),
+                   literal(db_comment.owner_id, Integer).label("owner_id"))
+            for db_comment in db_comments
+        )).subquery("new_comments")
+    # SQLite only parses an upsert from a SELECT that has a WHERE clause.
+    source = select(new_comments.c.text, new_comments.c.ad_id, new_comments.c.owner_id).join(
+        models.Ad, models.Ad.id == new_comments.c.ad_id
+    ).where(true())
+    return UPSERT_INSERTS[dialect_name](models.Comment).from_select(
+        ["text", "ad_id", "owner_id"], source
+    ).on_conflict_do_nothing(index_elements=["ad_id", "owner_id"]).returning(*COMMENT_COLUMNS)
+
+
+def increment_comment_count_query(ad_id: int, by: int = 1):
+    return update(models.Ad).where(models.Ad.id == ad_id).values(
+        comment_count=models.Ad.comment_count + by
+    ).execution_options(synchronize_session=False)
+
+
+def notify_query(channel: str, payload: str):
+    # Postgres delivers the notification when, and only if, the transaction commits.
+    return select(func.pg_notify(channel, payload))
+
+
+def reconcile_comment_counts_query(after_id: int, last_id: int):
+    """Sets comment_count from the comments table for the ads in (after_id, last_id] whose count has drifted."""
+    actual = select(func.count()).where(models.Comment.ad_id == models.Ad.id).scalar_subquery()
+    return update(models.Ad).where(
+        models.Ad.id > after_id, models.Ad.id <= last_id, models.Ad.comment_count != actual
+    ).values(comment_count=actual).execution_options(synchronize_session=False)
+
+
+def insert_ads_query():
+    # Executed with a list of rows, this becomes one multi-row INSERT whose RETURNING rows follow the input order.
+    return insert(models.Ad).returning(*AD_COLUMNS, sort_by_parameter_order=True)
+
+
+def delete_owned_ads_query(ad_ids, owner_id: int):
+    return sql_delete(models.Ad).where(models.Ad.id.in_(ad_ids), models.Ad.owner_id == owner_id).returning(
+        models.Ad.id
+    ).execution_options(synchronize_session=False)
+
+
+def existing_ad_ids_query(ad_ids):
+    return select(models.Ad.id).filter(models.Ad.id.in_(ad_ids))
+
+
 def find_ad_by_id(ad_id: int, db):
-    ad = db.execute(select(models.Ad).filter(models.Ad.id == ad_id)).scalar()
+    ad = db.execute(ad_by_id_query(ad_id)).scalar()
     return ad
 
 
-def find_ad_by_id_with_comments(ad_id: int, db):
-    return db.query(models.Ad).filter(models.Ad.id == ad_id).options(
-        subqueryload(models.Ad.comments)
-    ).first()
+def find_ads_page(after_id, limit: int, owner_id, db):
+    return db.execute(ads_page_query(after_id, limit, owner_id)).all()
+
+
+def find_popular_ads_page(after, limit: int, db):
+    return db.execute(popular_ads_page_query(after, limit)).all()
+
+
+def search_ads(text: str, limit: int, offset: int, db):
+    return db.execute(search_ads_query(text, limit, offset)).all()
+
+
+def find_ads_by_ids(ad_ids, db):
+    """Returns the ads with the given ids, in the order of ``ad_ids``; missing ids are skipped."""
+    ads = {ad.id: ad for ad in db.execute(ads_by_ids_query(ad_ids)).all()}
+    return [ads[ad_id] for ad_id in ad_ids if ad_id in ads]
+
+
+def find_owner_comments_page(owner_id: int, after_id, limit: int, db):
+    return db.execute(owner_comments_page_query(owner_id, after_id, limit)).all()
+
+
+def find_comments_by_ad_ids(ad_ids, per_ad_limit: int, db):
+    return db.execute(comments_by_ad_ids_query(ad_ids, per_ad_limit, db.get_bind().dialect.name)).all()
+
+
+def iterate_ads(db, batch_size: int = 1000):
+    return db.execute(select(*AD_COLUMNS).execution_options(yield_per=batch_size))
+
+
+def iterate_ads_with_comments(db, batch_size: int = 1000):
+    """Streams (ad columns, comment columns) rows ordered by ad, through a server-side cursor where supported."""
+    query = select(
+        *AD_COLUMNS, models.Comment.id.label("comment_id"), models.Comment.text.label("comment_text"),
+        models.Comment.owner_id.label("comment_owner_id"),
+    ).outerjoin(models.Comment, models.Comment.ad_id == models.Ad.id).order_by(models.Ad.id, models.Comment.id)
+    return db.execute(query.execution_options(yield_per=batch_size))
+
+
+def find_comments_page(ad_id: int, after_id, limit: int, db):
+    return db.execute(comments_page_query(ad_id, after_id, limit)).all()
+
+
+def ad_exists(ad_id: int, db):
+    return db.execute(ad_exists_query(ad_id)).scalar()
+
+
+def update_owned_ad(ad_id: int, owner_id: int, values: dict, db):
+    return db.execute(update_owned_ad_query(ad_id, owner_id, values)).first()
+
+
+def insert_comment(db_comment: models.Comment, db):
+    return db.execute(insert_comment_query(db_comment, db.get_bind().dialect.name)).first()
+
+
+def insert_comments(db_comments, db):
+    return db.execute(insert_comments_query(db_comments, db.get_bind().dialect.name)).all()
+
+
+def increment_comment_count(ad_id: int, db, by: int = 1):
+    db.execute(increment_comment_count_query(ad_id, by))
+
+
+def notify(channel: str, payload: str, db):
+    db.execute(notify_query(channel, payload))
+
+
+def insert_ads(rows, db):
+    return db.execute(insert_ads_query(), rows).all()
+
+
+def delete_owned_ads(ad_ids, owner_id: int, db):
+    return db.execute(delete_owned_ads_query(ad_ids, owner_id)).scalars().all()
+
+
+def find_existing_ad_ids(ad_ids, db):
+    return db.execute(existing_ad_ids_query(ad_ids)).scalars().all()
 
 
-def delete(db_ad: models.Ad, db):
-    db.delete(db_ad)
+def delete_owned_ad(ad_id: int, owner_id: int, db):
+    return db.execute(delete_owned_ad_query(ad_id, owner_id)).scalar()
@@ -0,0 +1,76 @@
+import models
+from repository.ad_repository import (
+    ad_by_id_query, ad_exists_query, ads_by_ids_query, ads_page_query, comments_by_ad_ids_query, comments_page_query,
+    delete_owned_ad_query, delete_owned_ads_query, existing_ad_ids_query, increment_comment_count_query,
+    insert_ads_query, insert_comment_query, insert_comments_query, notify_query, owner_comments_page_query,
+    popular_ads_page_query, update_owned_ad_query,
+)
+
+
+async def find_ad_by_id(ad_id: int, db):
+    return (await db.execute(ad_by_id_query(ad_id))).scalar()
+
+
+async def find_ads_page(after_id, limit: int, owner_id, db):
+    return (await db.execute(ads_page_query(after_id, limit, owner_id))).all()
+
+
+async def find_popular_ads_page(after, limit: int, db):
+    return (await db.execute(popular_ads_page_query(after, limit))).all()
+
+
+async def find_ads_by_ids(ad_ids, db):
+    ads = {ad.id: ad for ad in (await db.execute(ads_by_ids_query(ad_ids))).all()}
+    return [ads[ad_id] for ad_id in ad_ids if ad_id in ads]
+
+
+async def find_owner_comments_page(owner_id: int, after_id, limit: int, db):
+    return (await db.execute(owner_comments_page_query(owner_id, after_id, limit))).all()
+
+
+async def find_comments_by_ad_ids(ad_ids, per_ad_limit: int, db):
+    return (await db.execute(comments_by_ad_ids_query(ad_ids, per_ad_limit, db.get_bind().dialect.name))).all()
+
+
+async def find_comments_page(ad_id: int, after_id, limit: int, db):
+    return (await db.execute(comments_page_query(ad_id, after_id, limit))).all()
+
+
+async def ad_exists(ad_id: int, db):
+    return (await db.execute(ad_exists_query(ad_id))).scalar()
+
+
+async def update_owned_ad(ad_id: int, owner_id: int, values: dict, db):
+    return (await db.execute(update_owned_ad_query(ad_id, owner_id, values))).first()
+
+
+async def insert_comment(db_comment: models.Comment, db):
+    return (await db.execute(insert_comment_query(db_comment, db.get_bind().dialect.name))).first()
+
+
+async def insert_comments(db_comments, db):
+    return (await db.execute(insert_comments_query(db_comments, db.get_bind().dialect.name))).all()
+
+
+async def increment_comment_count(ad_id: int, db, by: int = 1):
+    await db.execute(increment_comment_count_query(ad_id, by))
+
+
+async def insert_ads(rows, db):
+    return (await db.execute(insert_ads_query(), rows)).all()
+
+
+async def notify(channel: str, payload: str, db):
+    await db.execute(notify_query(channel, payload))
+
+
+async def delete_owned_ads(ad_ids, owner_id: int, db):
+    return (await db.execute(delete_owned_ads_query(ad_ids, owner_id))).scalars().all()
+
+
+async def find_existing_ad_ids(ad_ids, db):
+    return (await db.execute(existing_ad_ids_query(ad_ids))).scalars().all()
+
+
+async def delete_owned_ad(ad_id: int, owner_id: int, db):
+    return (await db.execute(delete_owned_ad_query(ad_id, owner_id))).scalar()
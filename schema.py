@@ -0,0 +1,89 @@
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.schema import AddConstraint, CreateColumn
+
+import models
+from repository.ad_repository import reconcile_comment_counts_query
+
+# Arbitrary key of the Postgres advisory lock that serializes concurrent migrations.
+MIGRATION_LOCK_ID = 720_451_977
+
+
+def migrate(engine):
+    """Creates missing tables and indexes and upgrades existing tables; safe to run from several processes at once."""
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            # Held until the transaction ends, so a second migrator waits and then finds nothing left to do.
+            connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        models.Base.metadata.create_all(bind=connection)
+        # create_all skips tables that already exist, so columns and indexes added since have to be applied here.
+        inspector = inspect(connection)
+        added = []
+        for table in models.Base.metadata.sorted_tables:
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    definition = CreateColumn(column).compile(dialect=connection.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {definition}"))
+                    added.append(f"{table.name}.{column.name}")
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+            if connection.dialect.name == "postgresql":
+                # Only Postgres can swap a foreign key in place; elsewhere verify keeps reporting it.
+                for constraint, name in outdated_foreign_keys(inspector, table):
+                    connection.execute(text(f"ALTER TABLE {table.name} DROP CONSTRAINT {name}"))
+                    connection.execute(AddConstraint(constraint))
+        if connection.dialect.name == "postgresql":
+            for statement in models.SEARCH_DDL:
+                connection.execute(statement)
+    if "ads.comment_count" in added:
+        reconcile_comment_counts(engine)
+
+
+def reconcile_comment_counts(engine, batch_size: int = 10000) -> int:
+    """Recomputes ads.comment_count from the comments table and returns how many ads were off.
+
+    Works through the ads in id ranges, one short transaction each, so it can run against a live database.
+    """
+    with engine.connect() as connection:
+        last_id = connection.execute(select(func.max(models.Ad.id))).scalar() or 0
+    fixed = 0
+    for after_id in range(0, last_id, batch_size):
+        with engine.begin() as connection:
+            fixed += connection.execute(reconcile_comment_counts_query(after_id, after_id + batch_size)).rowcount
+    return fixed
+
+
+def outdated_foreign_keys(inspector, table):
+    """Yields (model constraint, database constraint name) for the foreign keys whose ON DELETE differs."""
+    existing = {tuple(fk["constrained_columns"]): fk for fk in inspector.get_foreign_keys(table.name)}
+    for constraint in table.foreign_key_constraints:
+        fk = existing.get(tuple(constraint.column_keys))
+        if fk is None:
+            continue
+        ondelete = (fk.get("options") or {}).get("ondelete")
+        if (ondelete or "").upper() != (constraint.ondelete or "").upper():
+            yield constraint, fk["name"]
+
+
+def verify(engine):
+    """Lists what ``migrate`` would still have to create; an empty list means the schema is up to date."""
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    problems = []
+    for table in models.Base.metadata.sorted_tables:
+        if table.name not in tables:
+            problems.append(f"missing table {table.name}")
+            continue
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        problems += [f"missing column {table.name}.{column.name}" for column in table.columns
+                     if column.name not in columns]
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        problems += [f"missing index {index.name}" for index in table.indexes if index.name not in indexes]
+        problems += [f"foreign key {name} is not ON DELETE {constraint.ondelete or 'NO ACTION'}"
+                     for constraint, name in outdated_foreign_keys(inspector, table)]
+    if engine.dialect.name == "postgresql" and "ads" in tables:
+        if "search_vector" not in {column["name"] for column in inspector.get_columns("ads")}:
+            problems.append("missing column ads.search_vector")
+        if "ix_ads_search_vector" not in {index["name"] for index in inspector.get_indexes("ads")}:
+            problems.append("missing index ix_ads_search_vector")
+    return problems
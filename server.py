@@ -0,0 +1,79 @@
+"""Production entry point: a gunicorn master that pre-forks uvicorn workers.
+
+    python server.py
+
+Workers run uvloop and httptools when those are installed. Signal the master to manage workers without downtime:
+HUP replaces every worker gracefully, and the new workers import the code afresh (e.g. after a deploy); TTIN and
+TTOU add or remove one worker.
+"""
+import logging
+import os
+
+from gunicorn.app.base import BaseApplication
+from uvicorn_worker import UvicornWorker
+
+import config
+import database
+
+logger = logging.getLogger("ad_hub.server")
+
+
+class Worker(UvicornWorker):
+    # "auto" picks uvloop and httptools when importable and falls back to asyncio and h11 otherwise.
+    CONFIG_KWARGS = {"loop": "auto", "http": "auto", "lifespan": "on"}
+
+
+def post_fork(server, worker):
+    database.after_fork()
+
+
+class Server(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from main import app
+        return app
+
+
+def shared_state_warnings(workers: int) -> list:
+    """Settings that keep state in each worker and so misbehave once there is more than one."""
+    if workers <= 1:
+        return []
+    warnings = []
+    if config.RESPONSE_CACHE_BACKEND != "redis":
+        warnings.append(f"RESPONSE_CACHE_BACKEND={config.RESPONSE_CACHE_BACKEND!r} caches per worker, so a worker "
+                        "may serve a listing another worker has changed until RESPONSE_CACHE_TTL; use 'redis'")
+    if config.COMMENT_FEED_BRIDGE != "postgres":
+        warnings.append("COMMENT_FEED_BRIDGE is not 'postgres', so comment streams only receive the comments posted "
+                        "through their own worker")
+    return warnings
+
+
+def options():
+    return {
+        "bind": config.SERVER_BIND,
+        "workers": config.WEB_CONCURRENCY,
+        "worker_class": Worker,
+        # Not preloaded: every worker imports the app itself, so a HUP picks up newly deployed code.
+        "preload_app": False,
+        "post_fork": post_fork,
+        "max_requests": config.SERVER_MAX_REQUESTS,
+        "max_requests_jitter": config.SERVER_MAX_REQUESTS_JITTER,
+        "graceful_timeout": config.SERVER_GRACEFUL_TIMEOUT,
+        "keepalive": config.SERVER_KEEPALIVE,
+        # Heartbeat files on tmpfs, so a slow container disk cannot make healthy workers look stuck.
+        "worker_tmp_dir": "/dev/shm" if os.path.isdir("/dev/shm") else None,
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for warning in shared_state_warnings(config.WEB_CONCURRENCY):
+        logger.warning(warning)
+    Server(options()).run()
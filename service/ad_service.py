@@ -1,69 +1,248 @@
+from collections import Counter
+from contextlib import contextmanager
+
 from sqlalchemy.exc import IntegrityError
 import models
-from database import session_factory
+from database import connection_released, session_factory
 from repository import ad_repository
+from cache.response_cache import ADS_NAMESPACE, POPULAR_ADS_NAMESPACE, comments_namespace, response_cache
+from service.comment_batcher import comment_batcher
+from service.comment_feed import CATCH_UP_BATCH, NOTIFY_CHANNEL, comment_feed
 from service.exception.entity_not_found import EntityNotFound
 from service.exception.unauthorized_action import UnauthorizedAction
+from service.pagination import decode_cursor, make_page
+from service.search_service import search_index
 from sqlalchemy.orm import Session
 
 
 def create_ad(db_ad: models.Ad, db: Session):
     db.add(db_ad)
     db.commit()
+    response_cache.invalidate(ADS_NAMESPACE, POPULAR_ADS_NAMESPACE)
     db.refresh(db_ad)
+    search_index.upsert(db_ad)
     return db_ad
 
 
-def find_all_ads(db: Session):
-    return db.query(models.Ad).all()
+def create_ads(ads, owner_id: int, db: Session):
+    created = ad_repository.insert_ads([{**ad, "owner_id": owner_id} for ad in ads], db)
+    db.commit()
+    response_cache.invalidate(ADS_NAMESPACE, POPULAR_ADS_NAMESPACE)
+    for ad in created:
+        search_index.upsert(ad)
+    return created
+
+
+def find_ads_page(limit: int, cursor, owner_id, db: Session):
+    after_id = decode_cursor(cursor)[0] if cursor else None
+    ads = ad_repository.find_ads_page(after_id, limit + 1, owner_id, db)
+    return make_page(ads, limit, key=lambda ad: (ad.id,))
+
+
+def find_ads_by_ids(ad_ids, db: Session):
+    ad_ids = list(dict.fromkeys(ad_ids))
+    return ads_with_missing_ids(ad_ids, ad_repository.find_ads_by_ids(ad_ids, db))
 
 
 def add_comment(db_comment: models.Comment, db: Session):
-    with db.begin_nested():
-        if not ad_repository.find_ad_by_id(db_comment.ad_id, db):
+    try:
+        comment = ad_repository.insert_comment(db_comment, db)
+    except IntegrityError:
+        # The ad was deleted between the EXISTS check and the foreign key check.
+        db.rollback()
+        raise EntityNotFound()
+    if comment is None:
+        if not ad_repository.ad_exists(db_comment.ad_id, db):
             raise EntityNotFound()
-        db.add(db_comment)
-        try:
-            db.commit()
-        except IntegrityError:
-            raise UserDuplicateCommentException()
-    db.refresh(db_comment)
-    return db_comment
-
-
-def find_all_comments_of_ad(ad_id: int, db: Session):
-    ad = ad_repository.find_ad_by_id_with_comments(ad_id, db)
-    if not ad:
+        raise UserDuplicateCommentException()
+    ad_repository.increment_comment_count(db_comment.ad_id, db)
+    if comment_feed.bridged:
+        ad_repository.notify(NOTIFY_CHANNEL, comment_feed.notification(comment), db)
+    db.commit()
+    response_cache.invalidate(comments_namespace(db_comment.ad_id), POPULAR_ADS_NAMESPACE)
+    comment_feed.publish(comment)
+    return comment
+
+
+def add_comments(db_comments, db: Session):
+    """Inserts many comments with one statement and one commit.
+
+    Returns, per comment and in order, the inserted row or the exception ``add_comment`` would have raised.
+    """
+    first = unique_comments(db_comments)
+    try:
+        inserted = ad_repository.insert_comments(list(first.values()), db)
+    except IntegrityError:
+        # An ad was deleted between the join and the foreign key check; add the comments one at a time instead.
+        db.rollback()
+        outcomes = []
+        for db_comment in db_comments:
+            with comment_outcome(outcomes):
+                outcomes.append(add_comment(db_comment, db))
+        return outcomes
+    inserted = {(comment.ad_id, comment.owner_id): comment for comment in inserted}
+    rejected = {db_comment.ad_id for db_comment in first.values()
+                if (db_comment.ad_id, db_comment.owner_id) not in inserted}
+    existing = set(ad_repository.find_existing_ad_ids(rejected, db)) if rejected else set()
+    counts = Counter(comment.ad_id for comment in inserted.values())
+    for ad_id, count in counts.items():
+        ad_repository.increment_comment_count(ad_id, db, by=count)
+    if comment_feed.bridged:
+        for comment in inserted.values():
+            ad_repository.notify(NOTIFY_CHANNEL, comment_feed.notification(comment), db)
+    db.commit()
+    forget_new_comments(counts, inserted.values())
+    return batch_comment_outcomes(db_comments, first, inserted, existing)
+
+
+async def add_comment_batched(db_comment: models.Comment, db: Session):
+    """``add_comment`` through the write-behind batch; the session is only used if this request flushes the batch."""
+    async def flush(db_comments):
+        with connection_released(db):
+            return add_comments(db_comments, db)
+
+    return await comment_batcher.add(db_comment, flush)
+
+
+def find_popular_ads_page(limit: int, cursor, db: Session):
+    after = decode_cursor(cursor, size=2) if cursor else None
+    ads = ad_repository.find_popular_ads_page(after, limit + 1, db)
+    return make_page(ads, limit, key=lambda ad: (ad.comment_count, ad.id))
+
+
+def find_comments_page(ad_id: int, limit: int, cursor, db: Session):
+    after_id = decode_cursor(cursor)[0] if cursor else None
+    comments = ad_repository.find_comments_page(ad_id, after_id, limit + 1, db)
+    # Only an empty first page can mean the ad does not exist, so that is the only case that pays for the lookup.
+    if not comments and after_id is None and not ad_repository.ad_exists(ad_id, db):
         raise EntityNotFound()
-    return ad.comments
+    return make_page(comments, limit, key=lambda comment: (comment.id,))
+
+
+def find_owner_comments_page(owner_id: int, limit: int, cursor, db: Session):
+    after_id = decode_cursor(cursor)[0] if cursor else None
+    comments = ad_repository.find_owner_comments_page(owner_id, after_id, limit + 1, db)
+    return make_page(comments, limit, key=lambda comment: (comment.id,))
+
+
+def check_ad_exists(ad_id: int, db: Session):
+    if not ad_repository.ad_exists(ad_id, db):
+        raise EntityNotFound()
+
+
+def find_comments_after(ad_id: int, after_id: int, db: Session):
+    """The next batch of the ad's comments for a comment feed catching up."""
+    return ad_repository.find_comments_page(ad_id, after_id, CATCH_UP_BATCH, db)
+
+
+def find_comments_by_ad_ids(ad_ids, per_ad_limit: int, db: Session):
+    ad_ids = list(dict.fromkeys(ad_ids))
+    rows = ad_repository.find_comments_by_ad_ids(ad_ids, per_ad_limit + 1, db)
+    return group_comments_by_ad(ad_ids, rows, per_ad_limit)
 
 
 def delete_ad(ad_id: int, current_user, db: Session):
-    with db.begin_nested():
-        ad = ad_repository.find_ad_by_id(ad_id, db)
-        if not ad:
-            raise EntityNotFound()
-        if ad.owner_id != current_user:
-            raise UnauthorizedAction()
-        ad_repository.delete(ad, db)
-        db.commit()
+    if ad_repository.delete_owned_ad(ad_id, current_user, db) is None:
+        _raise_missing_or_forbidden(ad_id, db)
+    db.commit()
+    forget_deleted_ads([ad_id])
+
+
+def delete_ads(ad_ids, current_user: int, db: Session):
+    """Deletes the caller's ads among ``ad_ids``; returns (ad id, exception or None) per distinct id, in order."""
+    ad_ids = list(dict.fromkeys(ad_ids))
+    deleted = set(ad_repository.delete_owned_ads(ad_ids, current_user, db))
+    remaining = [ad_id for ad_id in ad_ids if ad_id not in deleted]
+    existing = set(ad_repository.find_existing_ad_ids(remaining, db)) if remaining else set()
+    db.commit()
+    forget_deleted_ads(deleted)
+    return [(ad_id, bulk_delete_outcome(ad_id, deleted, existing)) for ad_id in ad_ids]
 
 
 def update_ad(ad_id: int, title: str, description: str, current_user: int, db: Session):
-    with db.begin_nested():
-        db_ad = ad_repository.find_ad_by_id(ad_id, db)
-        if not db_ad:
-            raise EntityNotFound()
-        if db_ad.owner_id != current_user:
-            raise UnauthorizedAction()
-        if title is not None:
-            db_ad.title = title
-        if description is not None:
-            db_ad.description = description
-        db.commit()
-    db.refresh(db_ad)
+    values = {key: value for key, value in (("title", title), ("description", description)) if value is not None}
+    db_ad = ad_repository.update_owned_ad(ad_id, current_user, values, db)
+    if db_ad is None:
+        _raise_missing_or_forbidden(ad_id, db)
+    db.commit()
+    response_cache.invalidate(ADS_NAMESPACE, POPULAR_ADS_NAMESPACE)
+    search_index.upsert(db_ad)
     return db_ad
 
 
+def forget_deleted_ads(ad_ids):
+    response_cache.invalidate(ADS_NAMESPACE, POPULAR_ADS_NAMESPACE, *(comments_namespace(ad_id) for ad_id in ad_ids))
+    for ad_id in ad_ids:
+        search_index.remove(ad_id)
+
+
+def unique_comments(db_comments):
+    """The first comment of each (ad_id, owner_id) pair; the later ones are duplicates within the batch."""
+    first = {}
+    for db_comment in db_comments:
+        first.setdefault((db_comment.ad_id, db_comment.owner_id), db_comment)
+    return first
+
+
+def batch_comment_outcomes(db_comments, first, inserted, existing):
+    outcomes = []
+    for db_comment in db_comments:
+        key = (db_comment.ad_id, db_comment.owner_id)
+        if key in inserted and first[key] is db_comment:
+            outcomes.append(inserted[key])
+        elif key in inserted or db_comment.ad_id in existing:
+            outcomes.append(UserDuplicateCommentException())
+        else:
+            outcomes.append(EntityNotFound())
+    return outcomes
+
+
+@contextmanager
+def comment_outcome(outcomes: list):
+    """Appends the error of a comment that cannot be added to ``outcomes`` instead of raising it."""
+    try:
+        yield
+    except (EntityNotFound, UserDuplicateCommentException) as error:
+        outcomes.append(error)
+
+
+def forget_new_comments(counts, comments):
+    if counts:
+        response_cache.invalidate(*(comments_namespace(ad_id) for ad_id in counts), POPULAR_ADS_NAMESPACE)
+    for comment in comments:
+        comment_feed.publish(comment)
+
+
+def ads_with_missing_ids(ad_ids, ads):
+    found = {ad.id for ad in ads}
+    return {"items": ads, "missing_ids": [ad_id for ad_id in ad_ids if ad_id not in found]}
+
+
+def group_comments_by_ad(ad_ids, rows, per_ad_limit: int):
+    """Turns the rows of a batch comment lookup into one page per existing ad, in the order of ``ad_ids``."""
+    comments = {}
+    for row in rows:
+        ad_comments = comments.setdefault(row.requested_ad_id, [])
+        if row.id is not None:
+            ad_comments.append(row)
+    return {
+        "ads": [{"ad_id": ad_id, **make_page(comments[ad_id], per_ad_limit, key=lambda comment: (comment.id,))}
+                for ad_id in ad_ids if ad_id in comments],
+        "missing_ad_ids": [ad_id for ad_id in ad_ids if ad_id not in comments],
+    }
+
+
+def bulk_delete_outcome(ad_id: int, deleted, existing):
+    if ad_id in deleted:
+        return None
+    return UnauthorizedAction() if ad_id in existing else EntityNotFound()
+
+
+def _raise_missing_or_forbidden(ad_id: int, db: Session):
+    if ad_repository.ad_exists(ad_id, db):
+        raise UnauthorizedAction()
+    raise EntityNotFound()
+
+
 class UserDuplicateCommentException(Exception):
     pass
@@ -0,0 +1,174 @@
+from collections import Counter
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from database import async_connection_released
+from repository import async_ad_repository
+from service.ad_service import (
+    UserDuplicateCommentException, ads_with_missing_ids, batch_comment_outcomes, bulk_delete_outcome,
+    comment_outcome, forget_deleted_ads, forget_new_comments, group_comments_by_ad, unique_comments,
+)
+from cache.response_cache import ADS_NAMESPACE, POPULAR_ADS_NAMESPACE, comments_namespace, response_cache
+from service.comment_batcher import comment_batcher
+from service.comment_feed import CATCH_UP_BATCH, NOTIFY_CHANNEL, comment_feed
+from service.exception.entity_not_found import EntityNotFound
+from service.exception.unauthorized_action import UnauthorizedAction
+from service.pagination import decode_cursor, make_page
+from service import search_service
+from service.search_service import search_index
+
+
+async def create_ad(db_ad: models.Ad, db: AsyncSession):
+    db.add(db_ad)
+    await db.commit()
+    response_cache.invalidate(ADS_NAMESPACE, POPULAR_ADS_NAMESPACE)
+    search_index.upsert(db_ad)
+    return db_ad
+
+
+async def create_ads(ads, owner_id: int, db: AsyncSession):
+    created = await async_ad_repository.insert_ads([{**ad, "owner_id": owner_id} for ad in ads], db)
+    await db.commit()
+    response_cache.invalidate(ADS_NAMESPACE, POPULAR_ADS_NAMESPACE)
+    for ad in created:
+        search_index.upsert(ad)
+    return created
+
+
+async def find_ads_page(limit: int, cursor, owner_id, db: AsyncSession):
+    after_id = decode_cursor(cursor)[0] if cursor else None
+    ads = await async_ad_repository.find_ads_page(after_id, limit + 1, owner_id, db)
+    return make_page(ads, limit, key=lambda ad: (ad.id,))
+
+
+async def search_ads(text: str, limit: int, cursor, db: AsyncSession):
+    return await db.run_sync(lambda session: search_service.search_ads(text, limit, cursor, session))
+
+
+async def find_ads_by_ids(ad_ids, db: AsyncSession):
+    ad_ids = list(dict.fromkeys(ad_ids))
+    return ads_with_missing_ids(ad_ids, await async_ad_repository.find_ads_by_ids(ad_ids, db))
+
+
+async def add_comment(db_comment: models.Comment, db: AsyncSession):
+    try:
+        comment = await async_ad_repository.insert_comment(db_comment, db)
+    except IntegrityError:
+        await db.rollback()
+        raise EntityNotFound()
+    if comment is None:
+        if not await async_ad_repository.ad_exists(db_comment.ad_id, db):
+            raise EntityNotFound()
+        raise UserDuplicateCommentException()
+    await async_ad_repository.increment_comment_count(db_comment.ad_id, db)
+    if comment_feed.bridged:
+        await async_ad_repository.notify(NOTIFY_CHANNEL, comment_feed.notification(comment), db)
+    await db.commit()
+    response_cache.invalidate(comments_namespace(db_comment.ad_id), POPULAR_ADS_NAMESPACE)
+    comment_feed.publish(comment)
+    return comment
+
+
+async def add_comments(db_comments, db: AsyncSession):
+    first = unique_comments(db_comments)
+    try:
+        inserted = await async_ad_repository.insert_comments(list(first.values()), db)
+    except IntegrityError:
+        await db.rollback()
+        outcomes = []
+        for db_comment in db_comments:
+            with comment_outcome(outcomes):
+                outcomes.append(await add_comment(db_comment, db))
+        return outcomes
+    inserted = {(comment.ad_id, comment.owner_id): comment for comment in inserted}
+    rejected = {db_comment.ad_id for db_comment in first.values()
+                if (db_comment.ad_id, db_comment.owner_id) not in inserted}
+    existing = set(await async_ad_repository.find_existing_ad_ids(rejected, db)) if rejected else set()
+    counts = Counter(comment.ad_id for comment in inserted.values())
+    for ad_id, count in counts.items():
+        await async_ad_repository.increment_comment_count(ad_id, db, by=count)
+    if comment_feed.bridged:
+        for comment in inserted.values():
+            await async_ad_repository.notify(NOTIFY_CHANNEL, comment_feed.notification(comment), db)
+    await db.commit()
+    forget_new_comments(counts, inserted.values())
+    return batch_comment_outcomes(db_comments, first, inserted, existing)
+
+
+async def add_comment_batched(db_comment: models.Comment, db: AsyncSession):
+    async def flush(db_comments):
+        async with async_connection_released(db):
+            return await add_comments(db_comments, db)
+
+    return await comment_batcher.add(db_comment, flush)
+
+
+async def find_popular_ads_page(limit: int, cursor, db: AsyncSession):
+    after = decode_cursor(cursor, size=2) if cursor else None
+    ads = await async_ad_repository.find_popular_ads_page(after, limit + 1, db)
+    return make_page(ads, limit, key=lambda ad: (ad.comment_count, ad.id))
+
+
+async def find_comments_page(ad_id: int, limit: int, cursor, db: AsyncSession):
+    after_id = decode_cursor(cursor)[0] if cursor else None
+    comments = await async_ad_repository.find_comments_page(ad_id, after_id, limit + 1, db)
+    if not comments and after_id is None and not await async_ad_repository.ad_exists(ad_id, db):
+        raise EntityNotFound()
+    return make_page(comments, limit, key=lambda comment: (comment.id,))
+
+
+async def find_owner_comments_page(owner_id: int, limit: int, cursor, db: AsyncSession):
+    after_id = decode_cursor(cursor)[0] if cursor else None
+    comments = await async_ad_repository.find_owner_comments_page(owner_id, after_id, limit + 1, db)
+    return make_page(comments, limit, key=lambda comment: (comment.id,))
+
+
+async def check_ad_exists(ad_id: int, db: AsyncSession):
+    if not await async_ad_repository.ad_exists(ad_id, db):
+        raise EntityNotFound()
+
+
+async def find_comments_after(ad_id: int, after_id: int, db: AsyncSession):
+    return await async_ad_repository.find_comments_page(ad_id, after_id, CATCH_UP_BATCH, db)
+
+
+async def find_comments_by_ad_ids(ad_ids, per_ad_limit: int, db: AsyncSession):
+    ad_ids = list(dict.fromkeys(ad_ids))
+    rows = await async_ad_repository.find_comments_by_ad_ids(ad_ids, per_ad_limit + 1, db)
+    return group_comments_by_ad(ad_ids, rows, per_ad_limit)
+
+
+async def delete_ad(ad_id: int, current_user, db: AsyncSession):
+    if await async_ad_repository.delete_owned_ad(ad_id, current_user, db) is None:
+        await _raise_missing_or_forbidden(ad_id, db)
+    await db.commit()
+    forget_deleted_ads([ad_id])
+
+
+async def delete_ads(ad_ids, current_user: int, db: AsyncSession):
+    ad_ids = list(dict.fromkeys(ad_ids))
+    deleted = set(await async_ad_repository.delete_owned_ads(ad_ids, current_user, db))
+    remaining = [ad_id for ad_id in ad_ids if ad_id not in deleted]
+    existing = set(await async_ad_repository.find_existing_ad_ids(remaining, db)) if remaining else set()
+    await db.commit()
+    forget_deleted_ads(deleted)
+    return [(ad_id, bulk_delete_outcome(ad_id, deleted, existing)) for ad_id in ad_ids]
+
+
+async def update_ad(ad_id: int, title: str, description: str, current_user: int, db: AsyncSession):
+    values = {key: value for key, value in (("title", title), ("description", description)) if value is not None}
+    db_ad = await async_ad_repository.update_owned_ad(ad_id, current_user, values, db)
+    if db_ad is None:
+        await _raise_missing_or_forbidden(ad_id, db)
+    await db.commit()
+    response_cache.invalidate(ADS_NAMESPACE, POPULAR_ADS_NAMESPACE)
+    search_index.upsert(db_ad)
+    return db_ad
+
+
+async def _raise_missing_or_forbidden(ad_id: int, db: AsyncSession):
+    if await async_ad_repository.ad_exists(ad_id, db):
+        raise UnauthorizedAction()
+    raise EntityNotFound()
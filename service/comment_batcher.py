@@ -0,0 +1,79 @@
+import asyncio
+
+from config import COMMENT_BATCH_MAX_DELAY_MS, COMMENT_BATCH_MAX_ITEMS
+
+
+class _Batch:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.comments = []
+        self.futures = []
+        self.full = asyncio.Event()
+
+
+class CommentBatcher:
+    """Groups the comments of concurrent requests so they are written by one INSERT and one commit.
+
+    The request that opens a batch leads it: it waits up to ``max_delay`` seconds, or until ``max_items`` comments
+    have joined, then writes the whole batch through its own ``flush``. Every request gets the outcome of its own
+    comment, so a duplicate or a missing ad still fails only the request that sent it.
+    """
+
+    def __init__(self, max_items: int, max_delay: float):
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self._batch = None
+
+    async def add(self, db_comment, flush):
+        """Returns the inserted comment or raises its exception.
+
+        ``flush(db_comments)`` writes a batch and returns, per comment, its row or the exception to raise.
+        """
+        batch = self._batch
+        leader = batch is None or batch.loop is not asyncio.get_running_loop()
+        if leader:
+            batch = self._batch = _Batch()
+        future = batch.loop.create_future()
+        batch.comments.append(db_comment)
+        batch.futures.append(future)
+        if len(batch.comments) >= self.max_items:
+            self._close(batch)
+        if leader:
+            lead = asyncio.ensure_future(self._lead(batch, flush))
+            try:
+                await asyncio.shield(lead)
+            except asyncio.CancelledError:
+                # The write runs on this request's session and may already hold the other requests' comments, so
+                # it is finished before the cancellation goes through.
+                while not lead.done():
+                    try:
+                        await asyncio.shield(lead)
+                    except asyncio.CancelledError:
+                        pass
+                raise
+        outcome = await future
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def _close(self, batch: _Batch):
+        batch.full.set()
+        if self._batch is batch:
+            self._batch = None
+
+    async def _lead(self, batch: _Batch, flush):
+        try:
+            try:
+                await asyncio.wait_for(batch.full.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._close(batch)
+            outcomes = await flush(batch.comments)
+        except Exception as error:
+            outcomes = [error] * len(batch.futures)
+        for future, outcome in zip(batch.futures, outcomes):
+            # A request that was cancelled while waiting has cancelled its future; its comment is written anyway.
+            if not future.done():
+                future.set_result(outcome)
+
+comment_batcher = CommentBatcher(COMMENT_BATCH_MAX_ITEMS, COMMENT_BATCH_MAX_DELAY_MS / 1000)
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import threading
+
+import orjson
+
+from config import COMMENT_FEED_BRIDGE, COMMENT_FEED_QUEUE_SIZE
+
+logger = logging.getLogger("ad_hub.comment_feed")
+
+NOTIFY_CHANNEL = "ad_hub_comments"
+# Postgres rejects NOTIFY payloads of 8000 bytes or more; longer comments are announced by id only.
+MAX_NOTIFY_PAYLOAD = 7900
+# Comments read from the database per query while a stream catches up.
+CATCH_UP_BATCH = 100
+# Pause before the LISTEN connection is opened again after it failed or was lost.
+LISTEN_RETRY_SECONDS = 2.0
+
+
+def encode_comment(comment) -> bytes:
+    """The comment as JSON, with the fields in the order of dto.Comment."""
+    return orjson.dumps({"text": comment.text, "id": comment.id, "owner_id": comment.owner_id,
+                         "ad_id": comment.ad_id})
+
+
+def sse_event(comment_id: int, payload: bytes) -> bytes:
+    return b"id: %d\nevent: comment\ndata: %s\n\n" % (comment_id, payload)
+
+
+class Subscription:
+    """The comments of one ad waiting to be sent to one client, in a queue bounded to ``queue_size``.
+
+    A full queue drops new comments and flags the subscription as ``missed``; the stream then reads what it missed
+    from the database once it has sent what is queued, so a slow client never holds up the publishers.
+    """
+
+    def __init__(self, ad_id: int, queue_size: int):
+        self.ad_id = ad_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(queue_size)
+        self.missed = False
+
+    def put(self, comment_id: int, payload: bytes):
+        try:
+            self.queue.put_nowait((comment_id, payload))
+        except asyncio.QueueFull:
+            self.missed = True
+
+    def miss(self):
+        self.missed = True
+        try:
+            # Wakes up a stream that is waiting on an empty queue.
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+
+class CommentFeed:
+    """Fans newly committed comments out to the event streams open in this process, grouped by ad.
+
+    Publishing may happen on any thread; delivery is handed to the event loop of each subscription. When
+    ``bridged``, comments are not delivered directly but sent through Postgres NOTIFY with the inserting
+    transaction, and every worker's ``listen`` task delivers them, its own worker included.
+    """
+
+    def __init__(self, queue_size: int, bridged: bool = False):
+        self.queue_size = queue_size
+        self.bridged = bridged
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, ad_id: int) -> Subscription:
+        subscription = Subscription(ad_id, self.queue_size)
+        with self._lock:
+            self._subscriptions.setdefault(ad_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.ad_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.ad_id]
+
+    def _each(self, ad_id, method, *args):
+        with self._lock:
+            if ad_id is None:
+                subscriptions = [s for group in self._subscriptions.values() for s in group]
+            else:
+                subscriptions = list(self._subscriptions.get(ad_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(getattr(subscription, method), *args)
+            except RuntimeError:
+                # The loop of a stream that was never closed has gone away.
+                self.unsubscribe(subscription)
+
+    def publish(self, comment):
+        """Called once the comment is committed."""
+        if not self.bridged:
+            self._each(comment.ad_id, "put", comment.id, encode_comment(comment))
+
+    def notification(self, comment) -> str:
+        payload = encode_comment(comment)
+        if len(payload) > MAX_NOTIFY_PAYLOAD:
+            payload = orjson.dumps({"id": comment.id, "ad_id": comment.ad_id})
+        return payload.decode()
+
+    def mark_missed(self, ad_id=None):
+        """Makes the streams of ``ad_id``, or all of them, catch up from the database."""
+        self._each(ad_id, "miss")
+
+    def on_notification(self, payload: str):
+        message = orjson.loads(payload)
+        if "text" in message:
+            self._each(message["ad_id"], "put", message["id"], payload.encode())
+        else:
+            self.mark_missed(message["ad_id"])
+
+    async def listen(self, dsn: str, retry_after: float = LISTEN_RETRY_SECONDS):
+        """Delivers the comments notified by every worker, reconnecting until cancelled."""
+        import asyncpg
+
+        while True:
+            try:
+                connection = await asyncpg.connect(dsn)
+            except (OSError, asyncpg.PostgresError) as error:
+                logger.warning("comment feed cannot listen, retrying in %ss: %s", retry_after, error)
+                await asyncio.sleep(retry_after)
+                continue
+            closed = asyncio.Event()
+            connection.add_termination_listener(lambda _: closed.set())
+            try:
+                await connection.add_listener(NOTIFY_CHANNEL, lambda *args: self.on_notification(args[-1]))
+                # Notifications sent while no connection was listening are lost, so the streams re-read them.
+                self.mark_missed()
+                await closed.wait()
+            finally:
+                if not connection.is_closed():
+                    await connection.close()
+            logger.warning("comment feed lost its listener connection, reconnecting in %ss", retry_after)
+            await asyncio.sleep(retry_after)
+
+    async def events(self, ad_id: int, after_id, fetch_after, heartbeat: float):
+        """Server-sent events of the ad: the comments after ``after_id`` first, then new ones as they are published.
+
+        ``fetch_after(after_id)`` returns up to CATCH_UP_BATCH listing rows of the ad with a larger id.
+        """
+        # Subscribed before the first read, so nothing committed in between is missed.
+        subscription = self.subscribe(ad_id)
+        last_id = after_id
+        caught_up = set()
+
+        async def catch_up():
+            nonlocal last_id
+            caught_up.clear()
+            while True:
+                rows = await fetch_after(last_id)
+                for row in rows:
+                    caught_up.add(row.id)
+                    last_id = max(last_id, row.id)
+                    yield sse_event(row.id, orjson.dumps(row._asdict()))
+                if len(rows) < CATCH_UP_BATCH:
+                    return
+
+        try:
+            # Sends the headers right away.
+            yield b": connected\n\n"
+            if after_id is not None:
+                async for event in catch_up():
+                    yield event
+            while True:
+                if subscription.missed and subscription.queue.empty():
+                    subscription.missed = False
+                    if last_id is not None:
+                        async for event in catch_up():
+                            yield event
+                    continue
+                try:
+                    item = await asyncio.wait_for(subscription.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                if item is None or item[0] in caught_up:
+                    continue
+                comment_id, payload = item
+                last_id = comment_id if last_id is None else max(last_id, comment_id)
+                yield sse_event(comment_id, payload)
+        finally:
+            self.unsubscribe(subscription)
+
+
+comment_feed = CommentFeed(COMMENT_FEED_QUEUE_SIZE, bridged=COMMENT_FEED_BRIDGE == "postgres")
@@ -0,0 +1,2 @@
+class InvalidCursor(Exception):
+    pass
@@ -0,0 +1,2 @@
+class ServiceOverloaded(Exception):
+    pass
@@ -0,0 +1,59 @@
+import csv
+import io
+import json
+from itertools import groupby
+
+from repository import ad_repository
+
+# Rows are buffered into chunks of about this size, except for the first one which is sent right away.
+CHUNK_SIZE = 64 * 1024
+CSV_HEADER = ("ad_id", "title", "description", "owner_id", "comment_id", "comment_text", "comment_owner_id")
+
+
+def _chunked(pieces):
+    buffer = []
+    size = 0
+    first = True
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if first or size >= CHUNK_SIZE:
+            yield "".join(buffer).encode()
+            buffer.clear()
+            size = 0
+            first = False
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+def _ndjson_lines(db):
+    rows = ad_repository.iterate_ads_with_comments(db)
+    for _, ad_rows in groupby(rows, key=lambda row: row.id):
+        ad_rows = list(ad_rows)
+        ad = ad_rows[0]
+        comments = [{"id": row.comment_id, "text": row.comment_text, "owner_id": row.comment_owner_id}
+                    for row in ad_rows if row.comment_id is not None]
+        yield json.dumps({"id": ad.id, "title": ad.title, "description": ad.description, "owner_id": ad.owner_id,
+                          "comments": comments}, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def _csv_lines(db):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADER)
+    yield buffer.getvalue()
+    for row in ad_repository.iterate_ads_with_comments(db):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        yield buffer.getvalue()
+
+
+def export_ndjson(db):
+    """One JSON object per ad, with its comments nested, in ad id order."""
+    return _chunked(_ndjson_lines(db))
+
+
+def export_csv(db):
+    """One row per comment, repeating the ad's columns; an ad without comments gets a single row."""
+    return _chunked(_csv_lines(db))
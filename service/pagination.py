@@ -0,0 +1,32 @@
+import base64
+import binascii
+import json
+
+from service.exception.invalid_cursor import InvalidCursor
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# Most ids a single batch lookup may ask for.
+MAX_BATCH_IDS = 100
+
+
+def encode_cursor(*keys):
+    raw = json.dumps(list(keys), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int = 1):
+    try:
+        keys = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise InvalidCursor()
+    if not isinstance(keys, list) or len(keys) != size or not all(type(key) is int for key in keys):
+        raise InvalidCursor()
+    return keys
+
+
+def make_page(rows, limit: int, key):
+    """Builds a page from ``limit + 1`` fetched rows; the extra row only signals that another page exists."""
+    items = list(rows[:limit])
+    next_cursor = encode_cursor(*key(items[-1])) if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
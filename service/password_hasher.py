@@ -0,0 +1,45 @@
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+from config import PASSWORD_HASH_EXECUTOR, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE
+from service.exception.service_overloaded import ServiceOverloaded
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+if PASSWORD_HASH_EXECUTOR == "process":
+    _executor = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+else:
+    _executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+# One slot per running or queued job; admission fails fast once they are all taken.
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_WORKERS + PASSWORD_HASH_MAX_QUEUE)
+
+
+def _hash(password):
+    return pwd_context.hash(password)
+
+
+def _verify(plain_password, hashed_password):
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def _submit(fn, *args):
+    if not _slots.acquire(blocking=False):
+        raise ServiceOverloaded()
+    try:
+        future = _executor.submit(fn, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+async def async_hash_password(password):
+    return await asyncio.wrap_future(_submit(_hash, password))
+
+
+async def async_verify_password(plain_password, hashed_password):
+    return await asyncio.wrap_future(_submit(_verify, plain_password, hashed_password))
@@ -0,0 +1,104 @@
+import math
+import re
+import threading
+
+from repository import ad_repository
+from service.exception.invalid_cursor import InvalidCursor
+from service.pagination import decode_cursor, make_page
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return _WORD.findall(text.lower()) if text else []
+
+
+class InvertedIndex:
+    """In-process full-text index of ad titles and descriptions, for databases without native text search.
+
+    It is built from the database on the first search and from then on kept current by the ad service's writes.
+    A worker only sees its own writes, so this fallback suits single-process deployments such as SQLite.
+    """
+
+    def __init__(self):
+        self.built = False
+        self._postings = {}
+        self._documents = {}
+        self._lock = threading.Lock()
+
+    def build(self, db):
+        with self._lock:
+            if self.built:
+                return
+            for ad in ad_repository.iterate_ads(db):
+                self._add(ad)
+            self.built = True
+
+    def upsert(self, ad):
+        with self._lock:
+            if self.built:
+                self._remove(ad.id)
+                self._add(ad)
+
+    def remove(self, ad_id: int):
+        with self._lock:
+            if self.built:
+                self._remove(ad_id)
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._documents.clear()
+            self.built = False
+
+    def search(self, text: str, limit: int, offset: int):
+        """Ids of the ads containing every word of ``text``, ranked by length-normalized tf-idf."""
+        terms = set(tokenize(text))
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in terms]
+            if not postings or not all(postings):
+                return []
+            postings.sort(key=len)
+            total = len(self._documents)
+            ranked = []
+            for ad_id in set(postings[0]).intersection(*postings[1:]):
+                length = self._documents[ad_id][1]
+                score = sum(posting[ad_id] / length * math.log(1 + total / len(posting)) for posting in postings)
+                ranked.append((-score, ad_id))
+        ranked.sort()
+        return [ad_id for _, ad_id in ranked[offset:offset + limit]]
+
+    def _add(self, ad):
+        words = tokenize(ad.title) + tokenize(ad.description)
+        counts = {}
+        for word in words:
+            counts[word] = counts.get(word, 0) + 1
+        self._documents[ad.id] = (tuple(counts), max(len(words), 1))
+        for word, count in counts.items():
+            self._postings.setdefault(word, {})[ad.id] = count
+
+    def _remove(self, ad_id: int):
+        document = self._documents.pop(ad_id, None)
+        if document is None:
+            return
+        for word in document[0]:
+            posting = self._postings[word]
+            del posting[ad_id]
+            if not posting:
+                del self._postings[word]
+
+
+search_index = InvertedIndex()
+
+
+def search_ads(text: str, limit: int, cursor, db):
+    offset = decode_cursor(cursor)[0] if cursor else 0
+    if offset < 0:
+        raise InvalidCursor()
+    if db.get_bind().dialect.name == "postgresql":
+        ads = ad_repository.search_ads(text, limit + 1, offset, db)
+    else:
+        search_index.build(db)
+        ads = ad_repository.find_ads_by_ids(search_index.search(text, limit + 1, offset), db)
+    # Ranked results have no stable key to seek from, so the cursor carries the offset of the next page.
+    return make_page(ads, limit, key=lambda ad: (offset + limit,))
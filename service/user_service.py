@@ -1,17 +1,23 @@
-from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from jose import jwt
-from database import session_factory
+from database import connection_released, session_factory
 import models
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from service.password_hasher import async_hash_password, async_verify_password
 
 
-def create_access_token(username, password, db: Session):
-    user = db.query(models.User).filter(models.User.email == username).first()
-    if not user or not verify_password(password, user.hashed_password):
+def find_user_by_email(email, db: Session):
+    # Released before the slow bcrypt check instead of being held for the whole request.
+    with connection_released(db):
+        return db.query(models.User).filter(models.User.email == email).first()
+
+
+async def create_access_token(username, password, db: Session):
+    user = await run_in_threadpool(find_user_by_email, username, db)
+    if not user or not await async_verify_password(password, user.hashed_password):
         return None
     expires_delta = timedelta(minutes=30)
     expire = datetime.utcnow() + expires_delta
@@ -20,20 +26,22 @@ def create_access_token(username, password, db: Session):
     return encoded_jwt
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-def create_user(user, db: Session):
-    hashed_password = pwd_context.hash(user.password)
+async def create_user(user, db: Session):
+    # Hashed before the session is touched, so no connection is held while bcrypt runs.
+    hashed_password = await async_hash_password(user.password)
     db_user = models.User(email=user.email, hashed_password=hashed_password)
-    try:
-        db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
-    except IntegrityError:
-        db.rollback()
-        raise DuplicatedUserException()
+    return await run_in_threadpool(insert_user, db_user, db)
+
+
+def insert_user(db_user: models.User, db: Session):
+    with connection_released(db):
+        try:
+            db.add(db_user)
+            db.commit()
+            db.refresh(db_user)
+        except IntegrityError:
+            db.rollback()
+            raise DuplicatedUserException()
     return db_user
 
 
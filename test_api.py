@@ -1,12 +1,45 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
 import pytest
+from jose import jwt
+from sqlalchemy import create_engine, select, text, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from starlette import status
 
 
-from controller.jwt_token import get_current_user
+from controller import ad_controller, async_ad_controller, db_routing
+from controller.ad_controller import router as ad_router
+from controller.async_ad_controller import router as async_ad_router
+from controller.jwt_token import TokenCache, get_current_user, token_cache
+from dto import AdPage, CommentPage, PopularAdPage
 from models import User, Ad, Comment
+from repository.ad_repository import reconcile_comment_counts_query
+from cache.backends import InMemoryCache, NullCache
+from cache.response_cache import ResponseCache, response_cache
 from main import app
+import schema
+from service import ad_service, async_ad_service, password_hasher
+from service.comment_batcher import CommentBatcher
+from service.comment_feed import CommentFeed, comment_feed
+from service.exception.entity_not_found import EntityNotFound
+from service.search_service import InvertedIndex
+from fastapi import Response
 from fastapi.testclient import TestClient
-from database import get_db, session_factory, engine
+import database
+from database import async_engine, connection_released, get_async_db, get_db, session_factory, engine
+
+
+@pytest.fixture(scope="session", autouse=True)
+def migrated_schema():
+    schema.migrate(engine)
 
 
 @pytest.fixture(scope="function")
@@ -15,7 +48,17 @@ def db_session():
     transaction = connection.begin()
     session = session_factory(bind=connection)
     session.begin_nested()
-    app.dependency_overrides[get_db] = lambda: session
+    response_cache.clear()
+
+    def request_session():
+        # Each request gets its own session, as in production, joined to the test transaction through a savepoint.
+        db = session_factory(bind=connection, join_transaction_mode="create_savepoint")
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = request_session
     yield session
     session.rollback()
     session.close()
@@ -50,6 +93,86 @@ def auth_with_user2(db_session, populate_users):
     app.dependency_overrides[get_current_user] = get_current_user
 
 
+Stack = namedtuple("Stack", "client run call service session")
+
+
+def use_ad_router(router, monkeypatch):
+    """Serves the ad endpoints of ``router`` in place of the ones the app was started with, for one test."""
+    ad_modules = (ad_controller.__name__, async_ad_controller.__name__)
+
+    def is_ad_route(route):
+        # Newer FastAPI releases keep an included router whole, older ones copy it route by route.
+        endpoint_module = getattr(getattr(route, "endpoint", None), "__module__", None)
+        return getattr(route, "original_router", None) in (ad_router, async_ad_router) or endpoint_module in ad_modules
+
+    routes = list(app.router.routes)
+    monkeypatch.setattr(app.router, "routes", list(routes))
+    app.include_router(router)
+    included = app.router.routes[len(routes):]
+    position = next(i for i, route in enumerate(routes) if is_ad_route(route))
+    app.router.routes[:] = [route for route in routes[:position] if not is_ad_route(route)] + included + [
+        route for route in routes[position:] if not is_ad_route(route)]
+
+
+@pytest.fixture(scope="function", params=["sync", "async"])
+def stack(request, db_session, monkeypatch):
+    """The ad endpoints and services of one stack, with ``run(fn)`` to set up data through a sync session."""
+    if request.param == "sync":
+        use_ad_router(ad_router, monkeypatch)
+
+        def run(fn):
+            result = fn(db_session)
+            db_session.commit()
+            return result
+
+        yield Stack(client, run, lambda fn, *args: fn(*args), ad_service, db_session)
+        app.dependency_overrides.pop(get_current_user, None)
+        return
+
+    use_ad_router(async_ad_router, monkeypatch)
+    # One portal for the whole test, so the connection stays on the event loop that opened it.
+    with TestClient(app) as async_client:
+        portal = async_client.portal
+        connection = portal.call(async_engine.connect)
+        transaction = portal.call(connection.begin)
+        session = AsyncSession(bind=connection, join_transaction_mode="create_savepoint", expire_on_commit=False)
+
+        async def request_session():
+            db = AsyncSession(bind=connection, join_transaction_mode="create_savepoint", expire_on_commit=False)
+            try:
+                yield db
+            finally:
+                await db.close()
+
+        def run(fn):
+            result = portal.call(session.run_sync, fn)
+            portal.call(session.commit)
+            return result
+
+        app.dependency_overrides[get_async_db] = request_session
+        yield Stack(async_client, run, portal.call, async_ad_service, session)
+        del app.dependency_overrides[get_async_db]
+        app.dependency_overrides.pop(get_current_user, None)
+        portal.call(session.close)
+        portal.call(transaction.rollback)
+        portal.call(connection.close)
+
+
+def act_as(user_id: int):
+    app.dependency_overrides[get_current_user] = lambda: user_id
+
+
+def seed_ads(db):
+    """Two users with one ad each; returns the user ids and the ad ids."""
+    users = [User(email="a@b.com", hashed_password="pass1"), User(email="c@d.com", hashed_password="pass2")]
+    db.add_all(users)
+    db.flush()
+    ads = [Ad(title=f"Ad {i + 1}", description=f"Ad of user {i + 1}", owner_id=user.id) for i, user in enumerate(users)]
+    db.add_all(ads)
+    db.flush()
+    return [user.id for user in users], [ad.id for ad in ads]
+
+
 def test_create_user(db_session):
     response = client.post("/register/", json={"email": "joe@doe.com", "password": "secret"})
     assert response.status_code == 201
@@ -79,6 +202,37 @@ def test_get_token_wrong_credentials(db_session):
     assert response.json().get("token_type") is None
 
 
+def test_auth_rejected_when_hash_pool_is_full(db_session, populate_users, monkeypatch):
+    monkeypatch.setattr(password_hasher, "_slots", threading.BoundedSemaphore(1))
+    password_hasher._slots.acquire()
+    response = client.post("/register/", json={"email": "joe@doe.com", "password": "secret"})
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    response = client.post("/token", data={"username": "a@b.com", "password": "pass1"})
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+def test_verified_token_is_cached():
+    token_cache.clear()
+    token = jwt.encode({"sub": "42", "exp": int(time.time()) + 60}, "SECRET_KEY", algorithm="HS256")
+    hits = token_cache.hits
+    assert get_current_user(token) == 42
+    assert get_current_user(token) == 42
+    assert token_cache.hits == hits + 1
+
+
+def test_token_cache_drops_expired_and_least_recent_entries():
+    cache = TokenCache(max_size=2)
+    cache.put("expired", 1, time.time() - 1)
+    assert cache.get("expired") is None
+    cache.put("a", 1, time.time() + 60)
+    cache.put("b", 2, time.time() + 60)
+    cache.get("a")
+    cache.put("c", 3, time.time() + 60)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats()["size"] == 2
+
+
 def test_add_ad_no_auth(db_session):
     ad_create_data = {"title": "Test Ad", "description": "Test Description"}
     response = client.post("/ads/", json=ad_create_data)
@@ -105,11 +259,47 @@ def populate_ads(db_session, populate_users):
     db_session.commit()
 
 
+def test_bulk_create_ads(db_session, auth_with_user1):
+    payload = [{"title": f"Bulk {i}", "description": f"Bulk ad {i}"} for i in range(3)]
+    response = client.post("/ads/bulk", json=payload)
+    assert response.status_code == status.HTTP_200_OK
+    results = response.json()["results"]
+    assert [(item["index"], item["status"]) for item in results] == [(0, 201), (1, 201), (2, 201)]
+    created = [item["ad"] for item in results]
+    assert [ad["title"] for ad in created] == ["Bulk 0", "Bulk 1", "Bulk 2"]
+    assert all(ad["owner_id"] == auth_with_user1.id for ad in created)
+    assert db_session.query(Ad).filter(Ad.id.in_([ad["id"] for ad in created])).count() == 3
+
+
+def test_bulk_create_reports_invalid_ads_and_creates_the_rest(db_session, auth_with_user1):
+    payload = [{"title": "Kept", "description": "Valid"}, {"title": "No description"}, {"description": None}]
+    results = client.post("/ads/bulk", json=payload).json()["results"]
+    assert [(item["index"], item["status"]) for item in results] == [(0, 201), (1, 422), (2, 422)]
+    assert results[0]["ad"]["title"] == "Kept" and results[1]["ad"] is None
+    assert "description" in results[1]["detail"] and "title" in results[2]["detail"]
+    assert db_session.query(Ad).filter(Ad.title == "No description").count() == 0
+
+
+def test_bulk_delete_reports_each_ad(db_session, populate_ads, auth_with_user1):
+    own = db_session.query(Ad).filter(Ad.title == "Ad 1").first()
+    other = db_session.query(Ad).filter(Ad.title == "Ad 2").first()
+    own_id, other_id, missing_id = own.id, other.id, invalid_ad_id(db_session)
+    db_session.add(Comment(ad_id=own_id, owner_id=auth_with_user1.id, text="Mine"))
+    db_session.commit()
+    response = client.post("/ads/bulk-delete", json={"ids": [own_id, other_id, missing_id]})
+    assert response.status_code == status.HTTP_200_OK
+    assert [(item["id"], item["status"]) for item in response.json()["results"]] == [
+        (own_id, 204), (other_id, 403), (missing_id, 404)
+    ]
+    assert db_session.query(Ad).filter(Ad.id == own_id).first() is None
+    assert db_session.query(Ad).filter(Ad.id == other_id).first() is not None
+
+
 def test_find_all_ads(db_session, populate_ads):
     response = client.get("/ads/")
     assert response.status_code == status.HTTP_200_OK
     ad1, ad2 = None, None
-    for ad in response.json():
+    for ad in response.json()["items"]:
         if ad["title"] == "Ad 1":
             ad1 = ad
         if ad["title"] == "Ad 2":
@@ -117,6 +307,338 @@ def test_find_all_ads(db_session, populate_ads):
     assert ad1 is not None and ad2 is not None
 
 
+def test_find_ads_paginated(db_session, populate_ads):
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 1} if cursor is None else {"limit": 1, "cursor": cursor}
+        response = client.get("/ads/", params=params)
+        assert response.status_code == status.HTTP_200_OK
+        body = response.json()
+        assert len(body["items"]) <= 1
+        seen.extend(ad["id"] for ad in body["items"])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == sorted(ad.id for ad in db_session.query(Ad).all())
+
+
+def test_find_my_ads(db_session, populate_ads, auth_with_user1):
+    db_session.add_all([Ad(title=f"Mine {i}", description="", owner_id=auth_with_user1.id) for i in range(3)])
+    db_session.commit()
+    titles = []
+    cursor = None
+    while True:
+        params = {"limit": 2} if cursor is None else {"limit": 2, "cursor": cursor}
+        response = client.get("/users/me/ads", params=params)
+        assert response.status_code == status.HTTP_200_OK
+        titles.extend(item["title"] for item in response.json()["items"])
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+    assert titles == ["Ad 1", "Mine 0", "Mine 1", "Mine 2"]
+
+
+def test_find_my_ads_no_auth(db_session):
+    response = client.get("/users/me/ads")
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_find_ads_by_ids(db_session, populate_ads):
+    ads = db_session.query(Ad).order_by(Ad.id.desc()).limit(2).all()
+    missing_id = invalid_ad_id(db_session)
+    response = client.get("/ads/batch", params={"ids": [ads[0].id, missing_id, ads[1].id, ads[0].id]})
+    assert response.status_code == status.HTTP_200_OK
+    assert [item["id"] for item in response.json()["items"]] == [ads[0].id, ads[1].id]
+    assert response.json()["missing_ids"] == [missing_id]
+
+
+def test_find_ads_by_owner(db_session, populate_ads):
+    u2 = db_session.query(User).filter(User.email == "c@d.com").first()
+    response = client.get("/ads/", params={"owner_id": u2.id})
+    assert response.status_code == status.HTTP_200_OK
+    assert [ad["title"] for ad in response.json()["items"]] == ["Ad 2"]
+
+
+def test_listings_match_dto_serialization_byte_for_byte(db_session, populate_ads, auth_with_user1):
+    ad = db_session.query(Ad).first()
+    client.post(f"/ads/{ad.id}/comments/", json={"text": "Grüße \"quoted\""})
+    listings = (("/ads/?limit=1", AdPage), ("/ads/popular", PopularAdPage), (f"/ads/{ad.id}/comments/", CommentPage))
+    for url, model in listings:
+        response = client.get(url)
+        assert response.content == model.model_validate(response.json()).model_dump_json().encode()
+
+
+def test_get_db_checks_out_a_connection_only_while_a_query_runs():
+    checked_out = engine.pool.checkedout()
+    dependency = get_db()
+    db = next(dependency)
+    assert db._session is None
+    with connection_released(db):
+        db.execute(text("SELECT 1"))
+        assert engine.pool.checkedout() == checked_out + 1
+    assert engine.pool.checkedout() == checked_out
+    dependency.close()
+
+
+def test_popular_ads_sorted_by_comment_count(db_session, populate_ads, auth_with_user1):
+    ad1 = db_session.query(Ad).filter(Ad.title == "Ad 1").first()
+    ad2 = db_session.query(Ad).filter(Ad.title == "Ad 2").first()
+    client.post(f"/ads/{ad2.id}/comments/", json={"text": "First"})
+    first = client.get("/ads/popular", params={"limit": 1}).json()
+    assert [(ad["id"], ad["comment_count"]) for ad in first["items"]] == [(ad2.id, 1)]
+
+    client.post(f"/ads/{ad1.id}/comments/", json={"text": "Mine"})
+    u2 = db_session.query(User).filter(User.email == "c@d.com").first()
+    app.dependency_overrides[get_current_user] = lambda: u2.id
+    client.post(f"/ads/{ad1.id}/comments/", json={"text": "Theirs"})
+    first = client.get("/ads/popular", params={"limit": 1}).json()
+    assert [(ad["id"], ad["comment_count"]) for ad in first["items"]] == [(ad1.id, 2)]
+    second = client.get("/ads/popular", params={"limit": 1, "cursor": first["next_cursor"]}).json()
+    assert [(ad["id"], ad["comment_count"]) for ad in second["items"]] == [(ad2.id, 1)]
+
+
+def test_reconcile_comment_counts_repairs_drift(db_session, populate_ads, auth_with_user1):
+    ad = db_session.query(Ad).filter(Ad.title == "Ad 1").first()
+    client.post(f"/ads/{ad.id}/comments/", json={"text": "Great!"})
+    db_session.execute(update(Ad).where(Ad.id == ad.id).values(comment_count=7))
+    assert db_session.execute(reconcile_comment_counts_query(0, ad.id)).rowcount == 1
+    db_session.expire_all()
+    assert db_session.get(Ad, ad.id).comment_count == 1
+
+
+def test_ads_cache_invalidated_by_writes(db_session, populate_ads, auth_with_user1):
+    titles = [ad["title"] for ad in client.get("/ads/").json()["items"]]
+    assert "New Ad" not in titles
+    created = client.post("/ads/", json={"title": "New Ad", "description": "Fresh"}).json()
+    assert "New Ad" in [ad["title"] for ad in client.get("/ads/").json()["items"]]
+    client.put(f"/ads/{created['id']}", json={"title": "Renamed Ad"})
+    titles = [ad["title"] for ad in client.get("/ads/").json()["items"]]
+    assert "Renamed Ad" in titles and "New Ad" not in titles
+    client.delete(f"/ads/{created['id']}")
+    assert "Renamed Ad" not in [ad["title"] for ad in client.get("/ads/").json()["items"]]
+
+
+def test_comments_cache_invalidated_by_new_comment(db_session, populate_ads, auth_with_user1):
+    ad = db_session.query(Ad).first()
+    assert client.get(f"/ads/{ad.id}/comments/").json()["items"] == []
+    client.post(f"/ads/{ad.id}/comments/", json={"text": "Great!"})
+    assert [c["text"] for c in client.get(f"/ads/{ad.id}/comments/").json()["items"]] == ["Great!"]
+
+
+def test_listings_answer_304_until_collection_changes(db_session, populate_ads, auth_with_user1):
+    ad = db_session.query(Ad).first()
+    for url in ("/ads/", f"/ads/{ad.id}/comments/"):
+        etag = client.get(url).headers["ETag"]
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert response.headers["ETag"] == etag and response.content == b""
+    etag = client.get(f"/ads/{ad.id}/comments/").headers["ETag"]
+    client.post(f"/ads/{ad.id}/comments/", json={"text": "Great!"})
+    response = client.get(f"/ads/{ad.id}/comments/", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["ETag"] != etag
+
+
+def test_etag_holds_across_workers_and_without_a_cache(db_session, populate_ads, monkeypatch):
+    etag = client.get("/ads/").headers["ETag"]
+    # Another worker, with a cache of its own, or with caching off, tags the same listing alike.
+    for backend in (InMemoryCache(max_entries=10), NullCache()):
+        monkeypatch.setattr(response_cache, "backend", backend)
+        response = client.get("/ads/", headers={"If-None-Match": etag})
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED and response.headers["ETag"] == etag
+
+
+def test_in_memory_cache_evicts_expired_and_least_recent_entries():
+    cache = InMemoryCache(max_entries=2)
+    cache.set("expired", b"x", ttl=-1)
+    assert cache.get("expired") is None
+    cache.set("a", b"1", ttl=60)
+    cache.set("b", b"2", ttl=60)
+    cache.get("a")
+    cache.set("c", b"3", ttl=60)
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1" and cache.get("c") == b"3"
+
+
+def test_metrics_report_route_latency_and_db_statements(db_session, populate_ads):
+    client.get("/ads/")
+    body = client.get("/metrics").text
+    assert 'ad_hub_request_duration_seconds_count{method="GET",route="/ads/"}' in body
+    assert 'ad_hub_db_statements_total{method="GET",route="/ads/"}' in body
+    assert 'ad_hub_requests_total{method="GET",route="/ads/",status="200"}' in body
+    assert "# TYPE ad_hub_response_cache_lookups_total counter" in body
+    assert 'ad_hub_response_cache_lookups_total{result="miss"}' in body
+    assert "# TYPE ad_hub_token_cache_lookups_total counter" in body
+    assert "# TYPE ad_hub_token_cache_size gauge" in body
+
+
+def test_metrics_report_connection_pool_usage(db_session):
+    body = client.get("/metrics").text
+    assert 'ad_hub_db_pool_wait_seconds_count{engine="sync"}' in body
+    assert 'ad_hub_db_pool_overflow_checkouts_total{engine="sync"}' in body
+    # The test transaction holds one connection for the whole test.
+    assert f'ad_hub_db_pool_connections{{engine="sync",state="checked_out"}} {engine.pool.checkedout()}' in body
+
+
+def test_statement_timeout_is_passed_in_the_driver_specific_way(monkeypatch):
+    monkeypatch.setattr(database, "DB_STATEMENT_TIMEOUT_MS", 1500)
+    psycopg_url = database.database_url("postgresql+psycopg2://u@h/db", "psycopg")
+    assert psycopg_url.drivername == "postgresql+psycopg"
+    assert database.engine_options(psycopg_url, None)["connect_args"] == {"options": "-c statement_timeout=1500"}
+    asyncpg_url = database.database_url("postgresql://u@h/db", "asyncpg")
+    assert database.engine_options(asyncpg_url, None)["connect_args"] == {
+        "server_settings": {"statement_timeout": "1500"}
+    }
+    assert "connect_args" not in database.engine_options(database.database_url("sqlite:///x.db", ""), None)
+
+
+def test_reads_go_to_replicas_unless_the_caller_just_wrote(monkeypatch):
+    replica_engines = [create_engine("sqlite://"), create_engine("sqlite://")]
+    replicas = database.ReplicaSet(replica_engines, "round_robin", retry_after=30)
+    assert {replicas.pick(), replicas.pick()} == set(replica_engines)
+    monkeypatch.setattr(db_routing, "replicas", replicas)
+    monkeypatch.setattr(db_routing, "READ_YOUR_WRITES_SECONDS", 5)
+    monkeypatch.setattr(database, "replicas", replicas)
+    primary = object()
+    assert next(db_routing.get_read_db(recent=False, db=primary)).get_bind() in replica_engines
+    response = Response()
+    next(db_routing.get_write_db(response=response, db=primary))
+    last_write = response.headers[db_routing.LAST_WRITE_HEADER]
+    assert f"{db_routing.LAST_WRITE_COOKIE}={last_write}" in response.headers["set-cookie"]
+    assert db_routing.wrote_recently(last_write_cookie=last_write, last_write_header=None)
+    assert db_routing.wrote_recently(last_write_cookie=None, last_write_header=last_write)
+    assert not db_routing.wrote_recently(last_write_cookie=db_routing.last_write_value(time.time() - 10),
+                                         last_write_header=None)
+    # Neither a time in the future nor an unsigned or forged one pins the reads to the primary.
+    assert not db_routing.wrote_recently(last_write_cookie=None,
+                                         last_write_header=db_routing.last_write_value(time.time() + 3600))
+    assert not db_routing.wrote_recently(last_write_cookie=None, last_write_header="1e12")
+    assert not db_routing.wrote_recently(last_write_cookie=None, last_write_header="inf:" + "0" * 32)
+    assert next(db_routing.get_read_db(recent=True, db=primary)) is primary
+
+
+def test_read_falls_back_to_the_primary_when_its_replica_is_unreachable():
+    broken, primary = create_engine("sqlite:////nonexistent/ad_hub.db"), create_engine("sqlite://")
+    replicas = database.ReplicaSet([broken], "round_robin", retry_after=30)
+    db = database.LazySession(lambda: session_factory(bind=replicas.pick() or primary),
+                              primary_factory=lambda: session_factory(bind=primary))
+    assert db.execute(text("SELECT 1")).scalar() == 1 and db.get_bind() is primary
+    assert replicas.pick() is None
+
+    async def read_through_dead_async_replica():
+        broken_async = create_async_engine("postgresql+asyncpg://ad_hub@127.0.0.1:1/ad_hub")
+        primary_async = create_async_engine(async_engine.url)
+        async_db = database.LazyAsyncSession(lambda: AsyncSession(bind=broken_async),
+                                             primary_factory=lambda: AsyncSession(bind=primary_async))
+        try:
+            return (await async_db.execute(text("SELECT 1"))).scalar()
+        finally:
+            await async_db.close()
+            await primary_async.dispose()
+
+    assert asyncio.run(read_through_dead_async_replica()) == 1
+
+
+def test_changed_listing_renders_from_the_primary_until_replicas_settle():
+    cache = ResponseCache(InMemoryCache(max_entries=10), ttl=60, settle_seconds=5)
+    replica, primary = object(), object()
+    read_db = database.LazySession(lambda: replica, primary_factory=lambda: primary)
+    cache.get_or_render("ads", "page", lambda: b"old", read_db=read_db)
+    assert read_db._session is None
+    cache.invalidate("ads")
+    cache.get_or_render("ads", "page", lambda: b"new" if read_db._factory() is primary else b"stale", read_db=read_db)
+    assert cache.get_or_render("ads", "page", lambda: b"again") == b"new"
+    untouched = database.LazySession(lambda: replica, primary_factory=lambda: primary)
+    cache.get_or_render("comments:1", "page", lambda: b"", read_db=untouched)
+    assert untouched._factory() is replica
+
+
+def test_unreachable_replica_is_skipped():
+    broken, healthy = create_engine("sqlite:////nonexistent/ad_hub.db"), create_engine("sqlite://")
+    replicas = database.ReplicaSet([broken, healthy], "round_robin", retry_after=30)
+    with pytest.raises(OperationalError):
+        broken.connect()
+    assert [replicas.pick() for _ in range(3)] == [healthy] * 3
+    replicas.mark_down(healthy)
+    assert replicas.pick() is None
+
+
+def test_migrate_is_idempotent_and_verify_reports_missing_objects():
+    schema.migrate(engine)
+    assert schema.verify(engine) == []
+    sqlite_engine = create_engine("sqlite://")
+    assert "missing table ads" in schema.verify(sqlite_engine)
+    schema.migrate(sqlite_engine)
+    assert schema.verify(sqlite_engine) == []
+
+
+def test_health_reports_the_serving_worker():
+    body = client.get("/health").json()
+    assert body["status"] == "ok" and body["pid"] == os.getpid()
+
+
+def test_server_warns_about_per_worker_state_with_several_workers(monkeypatch):
+    import server
+
+    monkeypatch.setattr(server.config, "RESPONSE_CACHE_BACKEND", "memory")
+    monkeypatch.setattr(server.config, "COMMENT_FEED_BRIDGE", "")
+    assert server.shared_state_warnings(1) == []
+    assert len(server.shared_state_warnings(4)) == 2
+    monkeypatch.setattr(server.config, "RESPONSE_CACHE_BACKEND", "redis")
+    monkeypatch.setattr(server.config, "COMMENT_FEED_BRIDGE", "postgres")
+    assert server.shared_state_warnings(4) == []
+    assert not server.options()["preload_app"]
+
+
+def test_find_ads_invalid_cursor(db_session):
+    response = client.get("/ads/", params={"cursor": "not-a-cursor"})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_search_ads(db_session, populate_ads, auth_with_user1):
+    client.post("/ads/", json={"title": "Red bicycle", "description": "A red bicycle in good condition"})
+    client.post("/ads/", json={"title": "Blue car", "description": "Comes with a red bicycle rack"})
+    client.post("/ads/", json={"title": "Green sofa", "description": "Barely used"})
+    response = client.get("/ads/search", params={"q": "red bicycle"})
+    assert response.status_code == status.HTTP_200_OK
+    assert [ad["title"] for ad in response.json()["items"]] == ["Red bicycle", "Blue car"]
+    first = client.get("/ads/search", params={"q": "red bicycle", "limit": 1}).json()
+    second = client.get("/ads/search", params={"q": "red bicycle", "limit": 1, "cursor": first["next_cursor"]}).json()
+    assert [ad["title"] for ad in first["items"] + second["items"]] == ["Red bicycle", "Blue car"]
+    assert second["next_cursor"] is None
+
+
+def test_inverted_index_tracks_writes():
+    index = InvertedIndex()
+    index.built = True
+    index.upsert(Ad(id=1, title="Red bicycle", description="Fast and red"))
+    index.upsert(Ad(id=2, title="Red car", description="Old"))
+    assert index.search("red", 10, 0) == [1, 2]
+    index.upsert(Ad(id=1, title="Blue bicycle", description="Fast"))
+    assert index.search("red", 10, 0) == [2]
+    index.remove(2)
+    assert index.search("red", 10, 0) == []
+
+
+def test_export_ads_ndjson(db_session, populate_ads, auth_with_user1):
+    ad = db_session.query(Ad).filter(Ad.title == "Ad 1").first()
+    db_session.add(Comment(ad_id=ad.id, owner_id=auth_with_user1.id, text="Nice"))
+    db_session.commit()
+    response = client.get("/export/ads")
+    assert response.status_code == status.HTTP_200_OK
+    records = {record["title"]: record for record in map(json.loads, response.text.splitlines())}
+    assert [comment["text"] for comment in records["Ad 1"]["comments"]] == ["Nice"]
+    assert records["Ad 2"]["comments"] == []
+
+
+def test_export_ads_csv(db_session, populate_ads):
+    response = client.get("/export/ads", params={"format": "csv"})
+    assert response.status_code == status.HTTP_200_OK
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert {"Ad 1", "Ad 2"} <= {row["title"] for row in rows}
+
+
 def invalid_ad_id(db_session):
     ids = [ad.id for ad in db_session.query(Ad).all()]
     return max(ids) + 1 if len(ids) > 0 else 1
@@ -133,6 +655,7 @@ def test_update_ad_authorized(db_session, populate_ads, auth_with_user1):
     response = client.put(f"/ads/{ad.id}", json={"title": "Updated title", "description": "Updated description"})
     assert response.status_code == status.HTTP_200_OK
 
+    db_session.expire_all()
     updated = db_session.query(Ad).filter(Ad.id == ad.id).first()
     assert updated.title == "Updated title" and updated.description == "Updated description"
 
@@ -154,14 +677,20 @@ def test_delete_ad_authorized(db_session, auth_with_user1):
     comment = Comment(ad_id=ad.id, owner_id=commenter.id, text="Wow!")
     db_session.add(comment)
     db_session.commit()
-    response = client.delete(f"/ads/{ad.id}")
+    ad_id, comment_id = ad.id, comment.id
+    response = client.delete(f"/ads/{ad_id}")
     assert response.status_code == status.HTTP_204_NO_CONTENT
-    retrieved_ad = db_session.query(Ad).filter(Ad.id == ad.id).first()
+    retrieved_ad = db_session.query(Ad).filter(Ad.id == ad_id).first()
     assert retrieved_ad is None
-    retrieved_comment = db_session.query(Comment).filter(Comment.id == comment.id).first()
+    retrieved_comment = db_session.query(Comment).filter(Comment.id == comment_id).first()
     assert retrieved_comment is None
 
 
+def test_delete_non_existing_ad(db_session, populate_ads, auth_with_user1):
+    response = client.delete(f"/ads/{invalid_ad_id(db_session)}")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
 def test_delete_ad_un_authorized(db_session, populate_ads, auth_with_user2):
     ad = db_session.query(Ad).filter(Ad.title == "Ad 1").first()
     response = client.delete(f"/ads/{ad.id}")
@@ -196,6 +725,119 @@ def test_add_comment_to_invalid_ad(db_session, populate_ads, auth_with_user1):
     assert response.status_code == status.HTTP_404_NOT_FOUND
 
 
+def test_add_comment_batched(db_session, populate_ads, auth_with_user1, monkeypatch):
+    monkeypatch.setattr(ad_controller, "COMMENT_WRITE_BATCHING", True)
+    ad = db_session.query(Ad).first()
+    response = client.post(f"/ads/{ad.id}/comments/", json={"text": "Batched!"})
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.json()["text"] == "Batched!" and response.json()["owner_id"] == auth_with_user1.id
+    response = client.post(f"/ads/{ad.id}/comments/", json={"text": "Again!"})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = client.post(f"/ads/{invalid_ad_id(db_session)}/comments/", json={"text": "Great!"})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_add_comments_reports_each_comment(db_session, populate_ads):
+    ad = db_session.query(Ad).filter(Ad.title == "Ad 1").first()
+    u1, u2 = (db_session.query(User).filter(User.email == email).first() for email in ("a@b.com", "c@d.com"))
+    db_session.add(Comment(ad_id=ad.id, owner_id=u2.id, text="Earlier"))
+    db_session.commit()
+    missing_id = invalid_ad_id(db_session)
+    outcomes = ad_service.add_comments([
+        Comment(ad_id=ad.id, owner_id=u1.id, text="First"),
+        Comment(ad_id=ad.id, owner_id=u1.id, text="Second"),
+        Comment(ad_id=ad.id, owner_id=u2.id, text="Later"),
+        Comment(ad_id=missing_id, owner_id=u1.id, text="Lost"),
+    ], db_session)
+    assert outcomes[0].text == "First" and outcomes[0].ad_id == ad.id
+    assert [type(outcome) for outcome in outcomes[1:]] == [
+        ad_service.UserDuplicateCommentException, ad_service.UserDuplicateCommentException, EntityNotFound,
+    ]
+    db_session.expire_all()
+    assert db_session.get(Ad, ad.id).comment_count == 1
+
+
+def test_add_comments_on_sqlite():
+    sqlite_engine = create_engine("sqlite://")
+    schema.migrate(sqlite_engine)
+    with session_factory(bind=sqlite_engine) as db:
+        (u1, u2), (ad, _) = seed_ads(db)
+        db.commit()
+        outcomes = ad_service.add_comments([
+            Comment(ad_id=ad, owner_id=u1, text="First"),
+            Comment(ad_id=ad, owner_id=u2, text="Second"),
+            Comment(ad_id=ad, owner_id=u1, text="Again"),
+            Comment(ad_id=ad + 100, owner_id=u1, text="Lost"),
+        ], db)
+        assert [outcome.text for outcome in outcomes[:2]] == ["First", "Second"]
+        assert [type(outcome) for outcome in outcomes[2:]] == [ad_service.UserDuplicateCommentException,
+                                                               EntityNotFound]
+        assert db.get(Ad, ad).comment_count == 2
+
+
+def test_deleting_an_ad_deletes_its_comments_on_sqlite():
+    sqlite_engine = database.enforce_foreign_keys(create_engine("sqlite://"))
+    schema.migrate(sqlite_engine)
+    with session_factory(bind=sqlite_engine) as db:
+        (u1, u2), (ad, _) = seed_ads(db)
+        db.add(Comment(ad_id=ad, owner_id=u2, text="Gone with the ad"))
+        db.commit()
+        ad_service.delete_ad(ad, u1, db)
+        assert db.scalars(select(Comment.text)).all() == []
+
+
+def test_comment_batcher_groups_concurrent_comments():
+    batcher = CommentBatcher(max_items=3, max_delay=0.05)
+    flushed = []
+
+    async def flush(comments):
+        flushed.append(list(comments))
+        return [ValueError(comment) if comment == "bad" else comment.upper() for comment in comments]
+
+    async def add(comment):
+        try:
+            return await batcher.add(comment, flush)
+        except ValueError:
+            return "rejected"
+
+    async def add_all():
+        return await asyncio.gather(*(add(comment) for comment in ["a", "bad", "c", "d"]))
+
+    assert asyncio.run(add_all()) == ["A", "rejected", "C", "D"]
+    assert flushed == [["a", "bad", "c"], ["d"]]
+
+
+def test_comment_batcher_survives_cancelled_requests():
+    batcher = CommentBatcher(max_items=10, max_delay=0.05)
+    flushed = []
+
+    async def flush(comments):
+        await asyncio.sleep(0.01)
+        flushed.append(list(comments))
+        return [comment.upper() for comment in comments]
+
+    async def add_all():
+        leader = asyncio.ensure_future(batcher.add("a", flush))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(batcher.add("b", flush))
+        last = asyncio.ensure_future(batcher.add("c", flush))
+        await asyncio.sleep(0)
+        follower.cancel()
+        first_results = (await leader, await last, follower.cancelled())
+        # A cancelled leader still writes the batch of the requests that joined it.
+        leader = asyncio.ensure_future(batcher.add("d", flush))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(batcher.add("e", flush))
+        await asyncio.sleep(0)
+        leader.cancel()
+        second_result = await follower
+        await asyncio.wait([leader])
+        return first_results, second_result, leader.cancelled()
+
+    assert asyncio.run(add_all()) == (("A", "C", True), "E", True)
+    assert flushed == [["a", "b", "c"], ["d", "e"]]
+
+
 def test_find_all_comments(db_session):
     ad = Ad(title="Ad 1", description="1st Ad")
     db_session.add(ad)
@@ -211,10 +853,185 @@ def test_find_all_comments(db_session):
     db_session.commit()
     response = client.get(f"/ads/{ad.id}/comments/")
     assert response.status_code == status.HTTP_200_OK
-    assert set([str(i) for i in range(10)]) == set([item['text'] for item in response.json()])
+    assert set([str(i) for i in range(10)]) == set([item['text'] for item in response.json()["items"]])
+
+
+def test_find_comments_paginated(db_session, populate_ads, auth_with_user1):
+    ad = db_session.query(Ad).first()
+    commenters = [User(email=f"commenter{i}", hashed_password="secret") for i in range(5)]
+    db_session.add_all(commenters)
+    db_session.commit()
+    db_session.add_all([Comment(ad_id=ad.id, owner_id=user.id, text=user.email) for user in commenters])
+    db_session.commit()
+    texts = []
+    cursor = None
+    while True:
+        params = {"limit": 2} if cursor is None else {"limit": 2, "cursor": cursor}
+        response = client.get(f"/ads/{ad.id}/comments/", params=params)
+        assert response.status_code == status.HTTP_200_OK
+        texts.extend(item["text"] for item in response.json()["items"])
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+    assert texts == [f"commenter{i}" for i in range(5)]
+
+
+def test_find_comments_of_ad_without_comments(db_session, populate_ads):
+    ad = db_session.query(Ad).first()
+    response = client.get(f"/ads/{ad.id}/comments/")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"items": [], "next_cursor": None}
+
+
+def test_find_my_comments(db_session, populate_ads, auth_with_user1):
+    ads = db_session.query(Ad).order_by(Ad.id.desc()).limit(3).all()
+    other = User(email="someone@else.com", hashed_password="secret")
+    db_session.add(other)
+    db_session.commit()
+    db_session.add_all([Comment(ad_id=ad.id, owner_id=auth_with_user1.id, text=f"mine {ad.id}") for ad in ads])
+    db_session.add(Comment(ad_id=ads[0].id, owner_id=other.id, text="not mine"))
+    db_session.commit()
+    first = client.get("/users/me/comments", params={"limit": 2}).json()
+    rest = client.get("/users/me/comments", params={"limit": 2, "cursor": first["next_cursor"]}).json()
+    assert [item["text"] for item in first["items"] + rest["items"]] == [f"mine {ad.id}" for ad in ads]
+    assert rest["next_cursor"] is None
+
+
+def test_find_comments_by_ad_ids(db_session, populate_ads):
+    ad, quiet_ad = db_session.query(Ad).order_by(Ad.id.desc()).limit(2).all()
+    commenters = [User(email=f"batch{i}", hashed_password="secret") for i in range(3)]
+    db_session.add_all(commenters)
+    db_session.commit()
+    db_session.add_all([Comment(ad_id=ad.id, owner_id=user.id, text=user.email) for user in commenters])
+    db_session.commit()
+    missing_id = invalid_ad_id(db_session)
+    response = client.get("/comments/batch", params={"ad_ids": [ad.id, missing_id, quiet_ad.id], "per_ad_limit": 2})
+    assert response.status_code == status.HTTP_200_OK
+    first, second = response.json()["ads"]
+    assert first["ad_id"] == ad.id and [item["text"] for item in first["items"]] == ["batch0", "batch1"]
+    assert second == {"ad_id": quiet_ad.id, "items": [], "next_cursor": None}
+    assert response.json()["missing_ad_ids"] == [missing_id]
+    rest = client.get(f"/ads/{ad.id}/comments/", params={"cursor": first["next_cursor"]})
+    assert [item["text"] for item in rest.json()["items"]] == ["batch2"]
 
 
 def test_find_all_comments_for_invalid_ad(db_session):
     invalid_id = invalid_ad_id(db_session)
     response = client.get(f"/ads/{invalid_id}/comments/")
     assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_comment_feed_pushes_committed_comments(db_session, populate_ads, auth_with_user1):
+    ad = db_session.query(Ad).first()
+
+    async def fetch_after(comment_id):
+        return []
+
+    async def receive():
+        events = comment_feed.events(ad.id, None, fetch_after, heartbeat=5)
+        assert await anext(events) == b": connected\n\n"
+        response = await asyncio.to_thread(client.post, f"/ads/{ad.id}/comments/", json={"text": "Live!"})
+        event = await asyncio.wait_for(anext(events), 5)
+        await events.aclose()
+        return response.json(), event
+
+    comment, event = asyncio.run(receive())
+    assert event == f"id: {comment['id']}\nevent: comment\ndata: {json.dumps(comment, separators=(',', ':'))}\n\n".encode()
+
+
+def test_comment_feed_resumes_and_catches_up_after_overflow():
+    CommentRow = namedtuple("CommentRow", ["text", "id", "owner_id", "ad_id"])
+    stored = [CommentRow(str(i), i, 1, 7) for i in range(1, 4)]
+    feed = CommentFeed(queue_size=2)
+
+    async def fetch_after(comment_id):
+        return [row for row in stored if row.id > comment_id]
+
+    async def receive():
+        events = feed.events(7, 1, fetch_after, heartbeat=5)
+        ids = []
+        assert await anext(events) == b": connected\n\n"
+        ids += [await anext(events), await anext(events)]
+        for i in range(4, 8):
+            stored.append(CommentRow(str(i), i, 1, 7))
+            feed.publish(stored[-1])
+        for _ in range(4):
+            ids.append(await asyncio.wait_for(anext(events), 5))
+        await events.aclose()
+        return [int(event.split(b"\n")[0].removeprefix(b"id: ")) for event in ids]
+
+    # 2 and 3 are resumed after id 1, 4 and 5 fit in the queue, 6 and 7 are read back after it overflowed.
+    assert asyncio.run(receive()) == [2, 3, 4, 5, 6, 7]
+
+
+def test_comment_stream_for_invalid_ad(db_session):
+    response = client.get(f"/ads/{invalid_ad_id(db_session)}/comments/stream")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_ad_endpoints_on_both_stacks(stack):
+    (user1, user2), (ad1, ad2) = stack.run(seed_ads)
+    act_as(user1)
+    response = stack.client.post("/ads/", json={"title": "New", "description": "Fresh ad"})
+    assert response.status_code == status.HTTP_201_CREATED and response.json()["owner_id"] == user1
+    created = response.json()["id"]
+    response = stack.client.post("/ads/bulk", json=[{"title": f"Bulk {i}", "description": "Bulk"} for i in range(2)]
+                                 + [{"title": "Invalid"}])
+    assert [(item["ad"] or {}).get("title") for item in response.json()["results"]] == ["Bulk 0", "Bulk 1", None]
+    assert [ad["title"] for ad in stack.client.get("/ads/", params={"owner_id": user2}).json()["items"]] == ["Ad 2"]
+    assert [ad["title"] for ad in stack.client.get("/users/me/ads").json()["items"]] == ["Ad 1", "New", "Bulk 0",
+                                                                                        "Bulk 1"]
+    assert stack.client.get("/ads/", params={"cursor": "garbage"}).status_code == status.HTTP_400_BAD_REQUEST
+    response = stack.client.get("/ads/batch", params={"ids": [ad2, created + 100, ad1]})
+    assert [ad["id"] for ad in response.json()["items"]] == [ad2, ad1]
+    assert response.json()["missing_ids"] == [created + 100]
+    assert [ad["id"] for ad in stack.client.get("/ads/search", params={"q": "fresh"}).json()["items"]] == [created]
+    response = stack.client.put(f"/ads/{created}", json={"title": "Renamed", "description": "Fresh ad"})
+    assert response.status_code == status.HTTP_200_OK and response.json()["title"] == "Renamed"
+    assert stack.client.put(f"/ads/{ad2}", json={"title": "Mine"}).status_code == status.HTTP_403_FORBIDDEN
+    assert stack.client.delete(f"/ads/{ad2}").status_code == status.HTTP_403_FORBIDDEN
+    assert stack.client.delete(f"/ads/{created}").status_code == status.HTTP_204_NO_CONTENT
+    assert stack.client.delete(f"/ads/{created}").status_code == status.HTTP_404_NOT_FOUND
+    response = stack.client.post("/ads/bulk-delete", json={"ids": [ad1, ad2, created]})
+    assert [(item["id"], item["status"]) for item in response.json()["results"]] == [
+        (ad1, 204), (ad2, 403), (created, 404)
+    ]
+
+
+def test_comment_endpoints_on_both_stacks(stack, monkeypatch):
+    (user1, user2), (ad1, ad2) = stack.run(seed_ads)
+    act_as(user1)
+    response = stack.client.post(f"/ads/{ad2}/comments/", json={"text": "Great!"})
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.json()["owner_id"] == user1 and response.json()["ad_id"] == ad2
+    assert stack.client.post(f"/ads/{ad2}/comments/", json={"text": "Again"}).status_code == 400
+    assert stack.client.post(f"/ads/{ad2 + 100}/comments/", json={"text": "Lost"}).status_code == 404
+    for controller in (ad_controller, async_ad_controller):
+        monkeypatch.setattr(controller, "COMMENT_WRITE_BATCHING", True)
+    assert stack.client.post(f"/ads/{ad1}/comments/", json={"text": "Batched"}).status_code == 201
+    assert stack.client.post(f"/ads/{ad1}/comments/", json={"text": "Again"}).status_code == 400
+    assert stack.client.post(f"/ads/{ad2 + 100}/comments/", json={"text": "Lost"}).status_code == 404
+    assert [c["text"] for c in stack.client.get(f"/ads/{ad2}/comments/").json()["items"]] == ["Great!"]
+    assert stack.client.get(f"/ads/{ad2 + 100}/comments/").status_code == status.HTTP_404_NOT_FOUND
+    assert [ad["id"] for ad in stack.client.get("/ads/popular", params={"limit": 2}).json()["items"]] == [ad2, ad1]
+    assert [c["text"] for c in stack.client.get("/users/me/comments").json()["items"]] == ["Great!", "Batched"]
+    response = stack.client.get("/comments/batch", params={"ad_ids": [ad2, ad2 + 100]})
+    assert [[c["text"] for c in ad["items"]] for ad in response.json()["ads"]] == [["Great!"]]
+    assert response.json()["missing_ad_ids"] == [ad2 + 100]
+    assert stack.client.get(f"/ads/{ad2 + 100}/comments/stream").status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_add_comments_reports_each_comment_on_both_stacks(stack):
+    (user1, user2), (ad1, ad2) = stack.run(seed_ads)
+    stack.run(lambda db: db.add(Comment(ad_id=ad1, owner_id=user2, text="Earlier")))
+    outcomes = stack.call(stack.service.add_comments, [
+        Comment(ad_id=ad1, owner_id=user1, text="First"),
+        Comment(ad_id=ad1, owner_id=user1, text="Second"),
+        Comment(ad_id=ad1, owner_id=user2, text="Later"),
+        Comment(ad_id=ad2 + 100, owner_id=user1, text="Lost"),
+    ], stack.session)
+    assert outcomes[0].text == "First" and outcomes[0].ad_id == ad1
+    assert [type(outcome) for outcome in outcomes[1:]] == [
+        ad_service.UserDuplicateCommentException, ad_service.UserDuplicateCommentException, EntityNotFound,
+    ]
+    assert stack.run(lambda db: db.execute(select(Ad.comment_count).where(Ad.id == ad1)).scalar_one()) == 1